@@ -0,0 +1,219 @@
+"""
+Reproducible performance benchmarks on synthetic images.
+
+    python benchmark.py                                  # quick run, 256 and 1k images
+    python benchmark.py --sizes all --qualities 10 50 90 --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json         # exits 1 if anything regressed
+
+For every size, downsample ratio and quality it reports encode/decode throughput (MP/s), time per
+codec stage (from a profiled run, see instrument.py), peak traced memory, save/load time, bytes on
+disk and PSNR. Every saliency dMode is benchmarked on its own as well, and so is the cold start import time
+of the modules a worker process loads.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import codec
+import compress
+import instrument
+import jpeg_class
+
+
+SIZES = {"256": (256, 256), "1k": (1024, 1024), "4k": (2160, 3840), "8k": (4320, 7680)}
+RATIOS = ["4:2:0", "4:2:2", "4:4:4", "4:1:1"]
+
+# metric: (direction, relative tolerance used when none is given on the command line)
+# speed gets the command line tolerance, size and quality are deterministic and only get a little slack
+METRICS = {"encode_mps": ("higher", None), "decode_mps": ("higher", None), "mps": ("higher", None),
+           "bytes": ("lower", 0.01), "psnr": ("higher", 0.001), "peak_bytes": ("lower", 0.05), "import_s": ("lower", None)}
+
+# what a headless worker imports
+IMPORTS = ["codec", "jpeg_class"]
+
+
+
+def synthetic_image(height, width, seed = 0):
+    # smooth gradients, a few hard edged shapes and some noise, so every frequency band has content
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(height, width)
+
+    img = np.stack([128 + 100 * np.sin(6 * x + 3 * y), 255 * x, 255 * (1 - y)], axis=-1)
+    for _ in range(8):
+        top, left = rng.integers(0, height), rng.integers(0, width)
+        img[top:top + height // 6, left:left + width // 6] = rng.integers(0, 256, 3)
+    img += rng.normal(0, 8, img.shape)
+
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+
+def megapixels_per_second(img, seconds):
+    return img.shape[0] * img.shape[1] / 1e6 / seconds
+
+
+
+def best_time(function, repeat):
+    # fastest of repeat runs, least disturbed by whatever else the machine is doing
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+
+def codec_case(img, q, ratio, memory = True, repeat = 3):
+    encode_s = best_time(lambda: jpeg_class.JPEG(img, q, downsample_ratio = ratio).encode(), repeat)
+    jpeg = jpeg_class.JPEG(img, q, downsample_ratio = ratio)
+    jpeg.encode()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "image.zst")
+        save_s = best_time(lambda: jpeg.save_image(path), repeat)
+        load_s = best_time(lambda: jpeg_class.JPEG.load_image(path), repeat)
+        size = os.path.getsize(path)
+        loaded = jpeg_class.JPEG.load_image(path)
+
+    # decode replaces the channels, so every run gets its own copy of the coefficients
+    state = loaded.__getstate__()
+    def decode():
+        loaded.__setstate__(dict(state))
+        loaded.decode()
+
+    decode_s = best_time(decode, repeat)
+
+    result = {"encode_mps": megapixels_per_second(img, encode_s), "decode_mps": megapixels_per_second(img, decode_s),
+              "save_s": save_s, "load_s": load_s, "bytes": size, "psnr": codec.psnr(img, loaded.img_array)}
+
+    # second, profiled run for the per stage breakdown, tracemalloc slows it down so its times stay out of the throughput
+    profiled = jpeg_class.JPEG(img, q, downsample_ratio = ratio)
+    profiled.report = instrument.Report(memory = memory)
+    profiled.encode()
+    profiled.decode()
+    totals = profiled.report.totals()
+
+    result["stages_s"] = {stage: total["wall_s"] for stage, total in totals.items()}
+    if memory:
+        result["peak_bytes"] = max(total["peak_bytes"] for total in totals.values())
+
+    return result
+
+
+
+def saliency_case(img, dMode, repeat = 3):
+    # with the saliency cache on every run after the first would only time a lookup
+    cached, jpeg_class.SALIENCY_CACHE = jpeg_class.SALIENCY_CACHE, None
+    try:
+        seconds = best_time(lambda: jpeg_class.JPEG(img, 50, dynamic = True, dMode = dMode), repeat)
+    finally:
+        jpeg_class.SALIENCY_CACHE = cached
+
+    return {"mps": megapixels_per_second(img, seconds)}
+
+
+
+def import_case(module, repeat = 3):
+    # every run in a fresh interpreter, less the time the interpreter takes to start with nothing to import
+    here = os.path.dirname(os.path.abspath(__file__))
+    def start(code):
+        return best_time(lambda: subprocess.run([sys.executable, "-c", code], cwd = here, check = True), repeat)
+
+    return {"import_s": start(f"import {module}") - start("pass")}
+
+
+
+def run(sizes, ratios, qualities, dmodes, memory = True, repeat = 3):
+    # one untimed round trip first so lazy imports and cached tables don't land in the first case
+    codec_case(synthetic_image(64, 64), 50, "4:2:0", memory = False, repeat = 1)
+    for dMode in dmodes:
+        saliency_case(synthetic_image(64, 64), dMode, repeat = 1)
+
+    results = {}
+
+    for module in IMPORTS:
+        name = f"import/{module}"
+        results[name] = import_case(module, repeat)
+        print(f"{name}: {results[name]['import_s'] * 1000:.0f} ms", flush = True)
+
+    for size in sizes:
+        img = synthetic_image(*SIZES[size])
+
+        for ratio in ratios:
+            for q in qualities:
+                name = f"codec/{size}/{ratio}/q{q}"
+                results[name] = codec_case(img, q, ratio, memory, repeat)
+                print(f"{name}: encode {results[name]['encode_mps']:.2f} MP/s, decode {results[name]['decode_mps']:.2f} MP/s, "
+                      f"{results[name]['bytes']} bytes, {results[name]['psnr']:.2f} dB", flush = True)
+
+        for dMode in dmodes:
+            name = f"saliency/{size}/{dMode}"
+            results[name] = saliency_case(img, dMode, repeat)
+            print(f"{name}: {results[name]['mps']:.2f} MP/s", flush = True)
+
+    return results
+
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a line for every metric that got worse than the baseline by more than its tolerance.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, (direction, fixed) in METRICS.items():
+            if metric not in metrics or metric not in baseline.get(name, {}):
+                continue
+
+            old, new = baseline[name][metric], metrics[metric]
+            allowed = tolerance if fixed is None else fixed
+            worse = new < old * (1 - allowed) if direction == "higher" else new > old * (1 + allowed)
+            if worse:
+                regressions.append(f"{name} {metric}: {old:.4g} -> {new:.4g}")
+
+    return regressions
+
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the codec on synthetic images.")
+    parser.add_argument("--sizes", nargs = "+", default = ["256", "1k"], help = f"any of {', '.join(SIZES)} or all")
+    parser.add_argument("--ratios", nargs = "+", default = RATIOS, choices = RATIOS)
+    parser.add_argument("--qualities", nargs = "+", type = int, default = [50])
+    parser.add_argument("--dmodes", nargs = "*", default = list(compress.DMODES), choices = compress.DMODES)
+    parser.add_argument("--repeat", type = int, default = 3, help = "timed runs per case, the fastest counts")
+    parser.add_argument("--no-memory", action = "store_true", help = "skip tracemalloc peak memory tracking")
+    parser.add_argument("--output", help = "write all results to this JSON file")
+    parser.add_argument("--save-baseline", help = "write results as a baseline JSON file")
+    parser.add_argument("--baseline", help = "compare against this baseline JSON file")
+    parser.add_argument("--tolerance", type = float, default = 0.15, help = "allowed relative throughput drop")
+    args = parser.parse_args(argv)
+
+    sizes = list(SIZES) if args.sizes == ["all"] else args.sizes
+    results = run(sizes, args.ratios, args.qualities, args.dmodes, memory = not args.no_memory, repeat = args.repeat)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against", args.baseline)
+
+
+
+if __name__ == "__main__":
+    main()
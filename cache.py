@@ -0,0 +1,118 @@
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+
+
+def content_key(array, **params):
+    """
+    Hash of an array's contents, shape and dtype together with params (anything else a cached value depends on).
+    """
+    digest = hashlib.blake2b(digest_size = 20)
+    digest.update(repr((array.shape, array.dtype.str, sorted(params.items()))).encode())
+    digest.update(np.ascontiguousarray(array).data)
+
+    return digest.hexdigest()
+
+
+
+class ArrayCache:
+    """
+    LRU cache of numpy arrays under content addressed keys (see content_key), holding at most max_bytes in memory.
+    With a directory every entry is also written there as <key>.npy and read back on a miss, so entries
+    outlive the process.  The directory isn't trimmed, delete it to start over.
+    Cached arrays are read only, they are handed out to every caller asking for the same key.
+    """
+    def __init__(self, max_bytes = 256 * 2 ** 20, directory = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+
+        if value is None:
+            value = self.read(key)
+            if value is not None:
+                self.remember(key, value)
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+
+    def put(self, key, value):
+        value = np.array(value) # own copy, nobody else can change it after this
+        value.flags.writeable = False
+        self.remember(key, value)
+
+        if self.directory is not None:
+            # write next to the final name and move it into place, a reader never sees half a file
+            fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, value, allow_pickle = False)
+            os.replace(tmp, self.path(key))
+
+        return value
+
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+
+        return value
+
+
+    def remember(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+
+            # an entry bigger than the whole budget isn't kept in memory, and doesn't push anything else out either
+            if value.nbytes > self.max_bytes:
+                return
+
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+
+            # least recently used go first
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last = False)
+                self.nbytes -= evicted.nbytes
+
+
+    def read(self, key):
+        if self.directory is None or not os.path.exists(self.path(key)):
+            return None
+
+        value = np.load(self.path(key), allow_pickle = False)
+        value.flags.writeable = False
+        return value
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
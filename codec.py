@@ -1,76 +1,103 @@
-import matplotlib.pyplot as plt
+import functools
+import threading
+import time
 import numpy as np
-import skimage.io as skio
-import scipy
-import rle
-import zlib
-from skimage.util import view_as_blocks
-from skimage.color import rgb2ycbcr, ycbcr2rgb
-import cv2
+import scipy.fft
+import scipy.fftpack
 
 
 # given an image, return image in YCbCr color space
 # instead of red, green, blue channels, one brightness channel and two channels indicating deviation in blue and red respectively
 # conversion taken from [wikipedia](https://en.wikipedia.org/wiki/YCbCr)
 # according to ITU-R BT.709 convension
-def rgb_to_YCbCr(img_array): 
-    #test
-    img = img_array / 255 # convert to floating_point
-    
-    # same matrix scipy usses for this
-    conv_matrix = np.matrix(
+# same matrix scipy usses for this
+YCBCR_MATRIX = np.array(
     [[65.481, 128.553, 24.966], 
      [-37.797, -74.203, 112.0], 
      [112.0, -93.786, -18.214]])
-    
-    # reshape to do matrix multiplication across color channels easier
-    img_reshape = np.reshape(img, (img.shape[0] * img.shape[1], img.shape[2]))
 
-    # do matrix multiplication to switch color spaces
-    converted_reshaped = img_reshape * np.transpose(conv_matrix)
+YCBCR_OFFSET = np.array([16, 128, 128])
+
+# pixels converted per matrix multiply, small enough that the float copy of a band stays in cache
+COLOR_BAND = 1 << 16
+
+
+
+@functools.lru_cache
+def color_matrices(dtype):
+    # forward matrix already divided by 255 so 8 bit pixels go in as they are, and the inverse is only ever taken once
+    forward = (YCBCR_MATRIX / 255).astype(dtype)
+    inverse = np.linalg.inv(YCBCR_MATRIX).astype(dtype)
+    offset = YCBCR_OFFSET.astype(dtype)
+
+    return forward, inverse, offset
 
-    # go back to original shape
-    converted = np.reshape(np.asarray(converted_reshaped), img.shape)
 
-   # print("----")
-    Y = converted[..., 0] + 16
-    Cb = converted[..., 1] + 128
-    Cr = converted[..., 2] + 128
+
+# dtype sets the floating point precision of the channels, float32 halves memory traffic through the codec
+def rgb_to_YCbCr(img_array, dtype = np.float64): 
+    forward, _, offset = color_matrices(np.dtype(dtype))
+
+    # one contiguous buffer per channel, filled a band of pixels at a time
+    # uint8 input is only ever converted to float one band at a time
+    pixels = np.reshape(img_array, (-1, 3))
+    channels = np.empty((3, pixels.shape[0]), dtype = dtype)
+
+    for start in range(0, pixels.shape[0], COLOR_BAND):
+        band = channels[:, start:start + COLOR_BAND]
+        np.matmul(forward, pixels[start:start + COLOR_BAND].T.astype(dtype), out = band)
+        band += offset[:, np.newaxis]
+
+    Y, Cb, Cr = np.reshape(channels, (3,) + img_array.shape[:-1])
 
     return (Y, Cb, Cr)
 
 
-def YCbCr_to_rgb(channel_array):
+def ycbcr_bands(channel_array):
+    # yields (start, stop, rgb) for each band of pixels, rgb scaled 0-1 in a reused buffer
+    channels = [np.reshape(channel, -1) for channel in channel_array]
+    dtype = np.result_type(channels[0], np.float32)
+    _, inverse, offset = color_matrices(dtype)
 
-    inv_matrix = np.matrix(
-    [[65.481, 128.553, 24.966], 
-     [-37.797, -74.203, 112.0], 
-     [112.0, -93.786, -18.214]])
-    
-    conv_matrix = np.linalg.inv(inv_matrix)
+    band = np.empty((COLOR_BAND, 3), dtype = dtype)
+    rgb = np.empty((COLOR_BAND, 3), dtype = dtype)
 
-    img = np.transpose(np.asarray(channel_array), (1, 2, 0))
+    for start in range(0, channels[0].shape[0], COLOR_BAND):
+        stop = min(start + COLOR_BAND, channels[0].shape[0])
+        part = band[:stop - start]
+        for k, channel in enumerate(channels):
+            np.subtract(channel[start:stop], offset[k], out = part[:, k])
 
-    img[..., 0] -= 16
-    img[..., 1] -= 128
-    img[..., 2] -= 128
+        yield start, stop, np.matmul(part, inverse.T, out = rgb[:stop - start])
 
-    # reshape to do matrix multiplication across color channels easier
-    img_reshape = np.reshape(img, (img.shape[0] * img.shape[1], img.shape[2]))
 
-    # do matrix multiplication to switch color spaces
-    before_rounding = img_reshape * np.transpose(conv_matrix)
 
-    range = before_rounding.max() - before_rounding.min()
-    before_rounding -= before_rounding.min()
-    before_rounding /= range
-    
-    # go back to original shape
-    converted = np.reshape(np.asarray(before_rounding), img.shape)
+# rounds and clips every pixel to 0-255 on its own, so any tile of an image decodes the same as the whole
+# normalize = True is the old behaviour of stretching the image's own min/max to 0-255 instead
+def YCbCr_to_rgb(channel_array, normalize = False):
+    shape = np.shape(channel_array[0]) + (3,)
+    pixels = shape[0] * shape[1]
+
+    if normalize:
+        before_rounding = np.empty((pixels, 3), dtype = np.result_type(channel_array[0], np.float32))
+        for start, stop, rgb in ycbcr_bands(channel_array):
+            before_rounding[start:stop] = rgb
+
+        rang = before_rounding.max() - before_rounding.min()
+        before_rounding -= before_rounding.min()
+        before_rounding /= rang
+        before_rounding *= 255
+
+        return np.reshape(before_rounding, shape).astype(np.uint8)
 
-    img_array = (converted * 255).astype(np.uint8)
+    img_array = np.empty((pixels, 3), dtype = np.uint8)
+    for start, stop, rgb in ycbcr_bands(channel_array):
+        rgb *= 255
+        np.rint(rgb, out = rgb)
+        np.clip(rgb, 0, 255, out = rgb)
+        img_array[start:stop] = rgb
 
-    return img_array
+    return np.reshape(img_array, shape)
 
 
 
@@ -86,11 +113,53 @@ def calculate_downsampling_ratios(ratio):
 
 
 
+def mcu_size(block_size, ratio):
+    # smallest (rows, cols) tile that splits into whole blocks in every channel after downsampling
+    factors = calculate_downsampling_ratios(ratio)
+    return (block_size * max(f[1] for f in factors), block_size * max(f[0] for f in factors))
+
+
+
+def pad_to_mcu(img_array, block_size, ratio):
+    # repeat the last row/column out to a whole number of MCUs, decode crops it off again
+    # works on a stack of images too, anything in front of (rows, cols, 3) is left alone
+    mcu_rows, mcu_cols = mcu_size(block_size, ratio)
+    pad_rows = -img_array.shape[-3] % mcu_rows
+    pad_cols = -img_array.shape[-2] % mcu_cols
+
+    if pad_rows == 0 and pad_cols == 0:
+        return img_array
+    
+    leading = ((0, 0),) * (img_array.ndim - 3)
+    return np.pad(img_array, leading + ((0, pad_rows), (0, pad_cols), (0, 0)), mode="edge")
+
+
+
+def region_blocks(x0, y0, x1, y1, shape, block_size, ratio):
+    # pixel window of whole MCUs around the region (x is the column, y the row, x1 and y1 exclusive)
+    # keeps one extra MCU on every side where there is one so chroma interpolation at the window's edge matches a full decode
+    # returns the window's top left corner and the block row/column slices it covers in each channel
+    mcu_rows, mcu_cols = mcu_size(block_size, ratio)
+    mcus_down = -(-shape[0] // mcu_rows)
+    mcus_across = -(-shape[1] // mcu_cols)
+
+    top = max(y0 // mcu_rows - 1, 0) * mcu_rows
+    bottom = min(-(-y1 // mcu_rows) + 1, mcus_down) * mcu_rows
+    left = max(x0 // mcu_cols - 1, 0) * mcu_cols
+    right = min(-(-x1 // mcu_cols) + 1, mcus_across) * mcu_cols
+
+    blocks = [(slice(top // f[1] // block_size, bottom // f[1] // block_size), 
+               slice(left // f[0] // block_size, right // f[0] // block_size)) for f in calculate_downsampling_ratios(ratio)]
+
+    return (top, left), blocks
+
+
+
 def downscale_colors(channel, **kwargs):
     i = kwargs["index"]
     ratio = kwargs["downsample_ratio"]
     factors = calculate_downsampling_ratios(ratio)[i]
-    return channel[::factors[1], ::factors[0]]
+    return channel[..., ::factors[1], ::factors[0]]
 
 
 
@@ -100,16 +169,23 @@ def rescale_colors(channel, **kwargs):
     ratio = kwargs["downsample_ratio"]
     factors = calculate_downsampling_ratios(ratio)[i]
     original_shape = (channel.shape[1] * factors[0], channel.shape[0] * factors[1])
+    import cv2 # only needed to decode, and slow to import
+
     resized = cv2.resize(channel, original_shape, interpolation=cv2.INTER_LINEAR)
 
     return resized
 
 
 
+# the encode steps only touch the last two (pixel) or last two block axes, so a stack of same sized images
+# with a leading batch axis goes through them in one pass
 def form_blocks(channel, **kwargs):
     block_size = kwargs['block_size']
+    rows, cols = channel.shape[-2] // block_size, channel.shape[-1] // block_size
     
-    return view_as_blocks(np.round(channel) / 255, (block_size, block_size))
+    # same (rows, cols, block_size, block_size) view view_as_blocks gives, for any leading axes
+    scaled = np.round(channel) / 255
+    return scaled.reshape(channel.shape[:-2] + (rows, block_size, cols, block_size)).swapaxes(-3, -2)
 
 
 
@@ -124,32 +200,140 @@ def reconstruct_blocks(channel, **kwargs):
 
 
 
+# DCT backends, picked with kwargs['dct_backend'] (and kwargs['dct_workers'] threads where the backend can use them)
+# all of them compute scipy.fftpack's unnormalized transforms over the last two axes: forward is a type II DCT,
+# inverse a type III that leaves the 4 * block_size^2 scaling to inverse_block_dct
+#   fftpack:  scipy.fftpack, single threaded
+#   scipy:    scipy.fft, split over dct_workers threads
+#   matmul:   one matrix product of all blocks (raveled) with a block_size^2 x block_size^2 basis, so it runs in BLAS
+#   auto:     the fastest of these on this machine, from a one time micro benchmark
+# backends can round differently in the last bit, so a quantized coefficient sitting right at a rounding edge may differ by one
+
+def fftpack_dct(blocks, workers = 1):
+    return scipy.fftpack.dctn(blocks, axes=(-2,-1))
+
+
+def fftpack_idct(blocks, workers = 1):
+    return scipy.fftpack.idctn(blocks, axes=(-2,-1))
+
+
+def scipy_dct(blocks, workers = 1):
+    return scipy.fft.dctn(blocks, axes=(-2,-1), workers = workers)
+
+
+def scipy_idct(blocks, workers = 1):
+    # "forward" puts all the scaling on the forward transform, so the inverse is left unscaled like fftpack's
+    return scipy.fft.idctn(blocks, axes=(-2,-1), norm = "forward", workers = workers)
+
+
+
+@functools.lru_cache
+def dct_basis(block_size, dtype):
+    # 1D: forward[k, n] = 2 cos(pi k (2n + 1) / 2N), inverse the same transposed with the DC column halved
+    # 2D on a raveled block: basis @ block @ basis.T is kron(basis, basis) @ block.ravel()
+    # the kron basis does 4x the multiplications of two separate 1D passes at block size 8, but as one large
+    # product with nothing transposed in between it measured about twice as fast as fftpack, the two pass version was slower
+    n = np.arange(block_size)
+    forward = 2 * np.cos(np.pi * np.outer(n, 2 * n + 1) / (2 * block_size))
+    inverse = forward.T.copy()
+    inverse[:, 0] /= 2
+
+    # transposed once here, so the transform is a plain blocks @ basis
+    forward, inverse = np.kron(forward, forward).T.astype(dtype), np.kron(inverse, inverse).T.astype(dtype)
+    forward.flags.writeable = inverse.flags.writeable = False
+
+    return forward, inverse
+
+
+
+def basis_transform(blocks, basis):
+    shape = blocks.shape
+    return np.dot(blocks.reshape(-1, shape[-2] * shape[-1]), basis).reshape(shape)
+
+
+def matmul_dct(blocks, workers = 1):
+    return basis_transform(blocks, dct_basis(blocks.shape[-1], blocks.dtype)[0])
+
+
+def matmul_idct(blocks, workers = 1):
+    return basis_transform(blocks, dct_basis(blocks.shape[-1], blocks.dtype)[1])
+
+
+
+DCT_BACKENDS = {"fftpack": (fftpack_dct, fftpack_idct), "scipy": (scipy_dct, scipy_idct), "matmul": (matmul_dct, matmul_idct)}
+# fftpack by default so the same image and q give the same bytes on every machine, "auto" is opt in
+DEFAULT_DCT_BACKEND = "fftpack"
+
+_DCT_TIMING_LOCK = threading.Lock()
+
+
+
+@functools.lru_cache
+def _time_dct_backends(block_size, dtype, workers):
+    # forward + inverse over the same 8192 random blocks, best of 3 runs per backend
+    sample = np.random.default_rng(0).standard_normal((64, 128, block_size, block_size)).astype(dtype)
+
+    timings = {}
+    for name, (forward, inverse) in DCT_BACKENDS.items():
+        runs = []
+        for _ in range(3):
+            start = time.perf_counter()
+            inverse(forward(sample, workers), workers)
+            runs.append(time.perf_counter() - start)
+        timings[name] = min(runs)
+
+    return min(timings, key = timings.get)
+
+
+
+def fastest_dct_backend(block_size, dtype, workers = 1):
+    # timed once per process, callers asking at the same time (the bands of a threaded encode) wait for
+    # that one run instead of timing against each other
+    with _DCT_TIMING_LOCK:
+        return _time_dct_backends(block_size, np.dtype(dtype), workers)
+
+
+
+def resolve_dct_backend(name, block_size, dtype, workers = 1):
+    # the concrete backend name asks for, "auto" becomes the fastest one
+    if name == "auto":
+        return fastest_dct_backend(block_size, dtype, workers)
+    if name not in DCT_BACKENDS:
+        raise ValueError(f"unknown DCT backend {name!r}, expected one of {sorted(DCT_BACKENDS)} or 'auto'")
+
+    return name
+
+
+
+def dct_transforms(channel, **kwargs):
+    # (forward, inverse) of the backend kwargs ask for, auto is timed on the dtype of channel
+    name = resolve_dct_backend(kwargs.get('dct_backend', DEFAULT_DCT_BACKEND), kwargs['block_size'], channel.dtype, kwargs.get('dct_workers', 1))
+
+    return DCT_BACKENDS[name]
+
+
+
 def calculate_blocked_dct(channel, **kwargs):
     channel -= 0.5 # want the whole thing centered at 0
-    dct = scipy.fftpack.dctn(channel, axes=(-2,-1))
+    forward, _ = dct_transforms(channel, **kwargs)
+    dct = forward(channel, kwargs.get('dct_workers', 1))
 
     return dct
 
 
 
 def inverse_block_dct(channel, **kwargs):
-    idct = scipy.fftpack.idctn(channel, axes=(-2,-1))
+    _, inverse = dct_transforms(channel, **kwargs)
+    idct = inverse(channel, kwargs.get('dct_workers', 1))
+    idct /= 4 * channel.shape[-2] * channel.shape[-1] # unnormalized dct followed by idct scales every axis by 2N
     idct += 0.5 # recenter to fit range
     
     return idct
 
 
 
-def calculate_quantization_matrix(quality):
-    #https://stackoverflow.com/questions/29215879/how-can-i-generalize-the-quantization-matrix-in-jpeg-compression
-    # as specified in JPEG standard
-
-    # should be defined between 0 and 100 but right now anything outside of (20,97) works pretty terrible.
-    # so we will first shift all values to be within that range 
-    quality = quality * 0.77 + 20
-
-    
-    default = np.array([
+# luminance table as specified in JPEG standard
+DEFAULT_QUANTIZATION = np.array([
     [16, 11, 10, 16, 24, 40, 51, 61],
     [12, 12, 14, 19, 26, 58, 60, 55],
     [14, 13, 16, 24, 40, 57, 69, 56],
@@ -159,14 +343,43 @@ def calculate_quantization_matrix(quality):
     [49, 64, 78, 87, 103, 121, 120, 101],
     [72, 92, 95, 98, 112, 100, 103, 99]
     ]).astype(np.uint16)
+
+
+
+def psnr(original, decoded):
+    # peak signal to noise ratio in dB between two 8 bit images
+    mse = np.mean((np.asarray(original, dtype = np.float64) - decoded) ** 2)
+    return 10 * np.log10(255 ** 2 / mse)
+
+
+
+def calculate_quantization_matrix(quality):
+    #https://stackoverflow.com/questions/29215879/how-can-i-generalize-the-quantization-matrix-in-jpeg-compression
+    # as specified in JPEG standard
+
+    # should be defined between 0 and 100 but right now anything outside of (20,97) works pretty terrible.
+    # so we will first shift all values to be within that range 
+    quality = quality * 0.77 + 20
     
     S = 5000/quality if quality < 50 else 200 - 2 * quality
 
-    modified = np.floor((S * default + 50) / 100)
+    modified = np.floor((S * DEFAULT_QUANTIZATION + 50) / 100)
     
     return modified.astype(np.uint8)
 
 
+
+@functools.lru_cache
+def quantization_table_bank():
+    # every integer quality from 0 to 100 computed once, indexed by quality
+    # dynamic quantization then turns a whole map of qualities into matrices with one gather
+    bank = np.stack([calculate_quantization_matrix(q) for q in range(101)])
+    bank.flags.writeable = False
+    
+    return bank
+
+
+
 def dynamic_quality(s,q):
     if q < 20:
         range = (0, 2 * q)
@@ -178,37 +391,39 @@ def dynamic_quality(s,q):
     low, high = range
     return low + (s * (high - low)) / 255
 
-    
 
-def quantize(channel, **kwargs):
+
+def dynamic_quality_indices(q_array, quality, factors):
+    # q_array holds one value per luma block, average it down to the block grid of a subsampled channel
+    if factors != (1, 1):
+        new_rows = q_array.shape[-2] // factors[1]
+        new_columns = q_array.shape[-1] // factors[0]
+        cropped = q_array[..., :new_rows * factors[1], :new_columns * factors[0]]
+        reshaped_array = cropped.reshape(q_array.shape[:-2] + (new_rows, factors[1], new_columns, factors[0]))
+        q_array = np.mean(reshaped_array, axis=(-3, -1))
+
+    q_array_standardized = dynamic_quality(q_array, quality) # shift q_array to qualities between 0 and 100
+
+    return np.clip(np.rint(q_array_standardized), 0, 100).astype(np.intp)
+
+
+
+def quantization_matrices(**kwargs):
+    # single matrix for the whole channel, or one per block (shape (rows, cols, 8, 8)) when dynamic
     quality = kwargs['q']
-    dynamic = kwargs['dynamic']
-    q_array = kwargs['q_array']
     i = kwargs["index"]
-    ratio = kwargs["downsample_ratio"]
-    factors = calculate_downsampling_ratios(ratio)[i]
+    factors = calculate_downsampling_ratios(kwargs["downsample_ratio"])[i]
+
+    if kwargs['dynamic']:
+        return quantization_table_bank()[dynamic_quality_indices(kwargs['q_array'], quality, factors)]
+
+    return calculate_quantization_matrix(quality)
 
     
-    if dynamic:
-        if factors != (1, 1):
-            # Calculate the number of rows and columns in the new array
-            new_rows = q_array.shape[0] // factors[0]
-            new_columns = q_array.shape[1] // factors[1]
-            reshaped_array = q_array[:new_rows*2, :new_columns*2].reshape(new_rows, 2, new_columns, 2)
-            q_array = np.mean(reshaped_array, axis=(1, 3))
-
-        q_array_standardized = dynamic_quality(q_array, quality) # shift q_array to qualities between 0 and 100
-        
-        quantize_array = [[calculate_quantization_matrix(q) for q in row] for row in q_array_standardized]
-        quantize_array = np.array(quantize_array)
-        
-        matrix = 1 / quantize_array
-        result = channel * matrix
-        
-    else:
-        matrix = 1 / calculate_quantization_matrix(quality)
-        
-        result = channel * matrix[np.newaxis, np.newaxis, :, :]
+
+def quantize(channel, **kwargs):
+    matrix = np.reciprocal(quantization_matrices(**kwargs), dtype = channel.dtype)
+    result = channel * matrix
         
     int_result = result.astype(np.int8) 
 
@@ -217,80 +432,151 @@ def quantize(channel, **kwargs):
     
 
 def dequantize(channel, **kwargs):
-    quality = kwargs['q']
-    dynamic = kwargs['dynamic']
-    q_array = kwargs['q_array']
-    i = kwargs["index"]
-    ratio = kwargs["downsample_ratio"]
-    factors = calculate_downsampling_ratios(ratio)[i]
-
-    
-    if dynamic:
-        if factors != (1, 1):
-            new_rows = q_array.shape[0] // factors[0]
-            new_columns = q_array.shape[1] // factors[1]
-            reshaped_array = q_array[:new_rows*2, :new_columns*2].reshape(new_rows, 2, new_columns, 2)
-            q_array = np.mean(reshaped_array, axis=(1, 3))
-
-        q_array_standardized = dynamic_quality(q_array, quality) # shift q_array to qualities between 0 and 100
-        
-        quantize_array = [[calculate_quantization_matrix(q) for q in row] for row in q_array_standardized]
-        matrix = np.array(quantize_array)
-        
-        result = channel * matrix
-        
-    else:
-        matrix = calculate_quantization_matrix(quality)
-        result = channel * matrix[np.newaxis, np.newaxis, :, :]
+    matrix = quantization_matrices(**kwargs)
+    result = np.multiply(channel, matrix, dtype = kwargs.get('dtype', np.float64))
     
     return result
 
 
 
-def zigzag(channel, **kwargs):
-    block_size = kwargs['block_size']
-    
+@functools.lru_cache
+def zigzag_order(block_size):
     #https://stackoverflow.com/questions/39440633/matrix-to-vector-with-python-numpy
     canon_order = np.reshape(np.arange(0, block_size ** 2), (block_size, block_size))
     
     zigzag_order =  np.concatenate([np.diagonal(canon_order[::-1,:], 
                                                 k)[::(2*(k % 2)-1)] for k in range(1 - block_size, block_size)])
-    zigzagged = np.empty_like(channel)
-    zigzagged = np.reshape(zigzagged, newshape = (zigzagged.shape[0], zigzagged.shape[1], zigzagged.shape[-1] * zigzagged.shape[-2]))
 
-    a, b, _, _ = channel.shape
-    
-    for i in range(a):
-        for j in range(b):
-            # ravel and order with fixed ordering every time
-            zigzagged[i,j] = np.ravel(channel[i,j])[zigzag_order]
+    # get back to canonical basis
+    inv_order = np.argsort(zigzag_order)
+
+    return zigzag_order, inv_order
+
 
-    return zigzagged
+
+def zigzag(channel, **kwargs):
+    block_size = kwargs['block_size']
+    order, _ = zigzag_order(block_size)
+
+    # ravel every block and reorder them all at once with the fixed ordering
+    raveled = np.reshape(channel, channel.shape[:-2] + (block_size ** 2,))
+
+    return np.take(raveled, order, axis=-1)
 
     
 
 def unzigzag(channel, **kwargs):
     block_size = kwargs['block_size']
-    
-    #https://stackoverflow.com/questions/39440633/matrix-to-vector-with-python-numpy
-    canon_order = np.reshape(np.arange(0, block_size ** 2), (block_size, block_size))
-    
-    zigzag_order =  np.concatenate([np.diagonal(canon_order[::-1,:], 
-                                                k)[::(2*(k % 2)-1)] for k in range(1 - block_size, block_size)])
+    _, inv_order = zigzag_order(block_size)
 
-    # get back to canonical basis
-    inv_order = np.argsort(zigzag_order)
- 
-    
-    channel_reconstructed = np.zeros((channel.shape[0], channel.shape[1], block_size, block_size), dtype = channel.dtype)
-    a, b, c = channel.shape
-    
-    for i in range(a):
-        for j in range(b):
-            raveled_fixed_order = channel[i,j][inv_order]
-            channel_reconstructed[i,j] = np.reshape(raveled_fixed_order,(8,8))
+    raveled_fixed_order = np.take(channel, inv_order, axis=-1)
+
+    return np.reshape(raveled_fixed_order, channel.shape[:-1] + (block_size, block_size))
+
+
+# block rows handled per pass of fused_encode, keeps its scratch buffers small enough to stay in cache
+FUSED_BAND_ROWS = 8
+
+
+
+def fused_encode(channel, **kwargs):
+    # steps 3-6 (blocking, DCT, quantizing, zigzagging) in one pass over bands of block rows
+    # scratch buffers are reused from band to band and every stage works in place, output is the same as running the steps one by one
+    # a channel that is already blocked and transformed (4 dimensional) picks up at quantizing
+    block_size = kwargs['block_size']
+    order, _ = zigzag_order(block_size)
+    transformed = channel.ndim == 4
+    rows, cols = channel.shape[:2] if transformed else (channel.shape[0] // block_size, channel.shape[1] // block_size)
+
+    if kwargs['dynamic']:
+        factors = calculate_downsampling_ratios(kwargs["downsample_ratio"])[kwargs["index"]]
+        indices = dynamic_quality_indices(kwargs['q_array'], kwargs['q'], factors)
+    else:
+        reciprocal = np.reciprocal(calculate_quantization_matrix(kwargs['q']), dtype = channel.dtype)
+
+    forward, _ = dct_transforms(channel, **kwargs)
+
+    zigzagged = np.empty((rows, cols, block_size ** 2), dtype = np.int8)
+    pixels = np.empty((FUSED_BAND_ROWS * block_size, cols * block_size), dtype = channel.dtype)
+    quantized = np.empty((FUSED_BAND_ROWS, cols, block_size, block_size), dtype = np.int8)
+
+    for row in range(0, rows, FUSED_BAND_ROWS):
+        band = min(FUSED_BAND_ROWS, rows - row)
+
+        if transformed:
+            dct = channel[row:row + band].copy()
+        else:
+            shifted = pixels[:band * block_size]
+            np.round(channel[row * block_size:(row + band) * block_size], out = shifted)
+            shifted /= 255
+            shifted -= 0.5 # want the whole thing centered at 0
+            blocks = shifted.reshape(band, block_size, cols, block_size).transpose(0, 2, 1, 3)
+            dct = forward(blocks, kwargs.get('dct_workers', 1))
+
+        if kwargs['dynamic']:
+            reciprocal = np.reciprocal(quantization_table_bank()[indices[row:row + band]], dtype = channel.dtype)
+
+        dct *= reciprocal
+        np.copyto(quantized[:band], dct, casting = "unsafe")
+        np.take(quantized[:band].reshape(band, cols, block_size ** 2), order, axis=-1, out = zigzagged[row:row + band])
+
+    return zigzagged
+
+
+
+def reduced_blocks(channel, **kwargs):
+    # straight from zigzagged coefficients to a channel shrunk by keep / block_size, used for thumbnails
+    # only the top left keep x keep coefficients of each block are read and dequantized
+    block_size = kwargs['block_size']
+    keep = kwargs['keep']
+    _, inv_order = zigzag_order(block_size)
+
+    positions = np.reshape(inv_order, (block_size, block_size))[:keep, :keep]
+    coefficients = channel[..., positions] * quantization_matrices(**kwargs)[..., :keep, :keep]
+
+    if keep == 1:
+        # DC alone is 4 * block_size^2 times the block mean, no inverse transform needed
+        blocks = coefficients / (4 * block_size ** 2)
+    else:
+        # rescale to the orthonormal DCT, then a keep-point inverse of the low frequencies approximates block averages
+        scale = np.full(keep, 1 / np.sqrt(2 * block_size))
+        scale[0] /= np.sqrt(2)
+        coefficients = coefficients * np.outer(scale, scale)
+        blocks = scipy.fft.idctn(coefficients, axes=(-2,-1), norm="ortho") * (keep / block_size)
+
+    blocks += 0.5 # recenter to fit range
+
+    return reconstruct_blocks(blocks, block_size = keep)
+
+
+
+# steps 2-6 of encoding, and decoding's inverses listed in the same order (decode runs them back to front)
+ENCODE_STEPS = [downscale_colors, form_blocks, calculate_blocked_dct, quantize, zigzag]
+DECODE_STEPS = [rescale_colors, reconstruct_blocks, inverse_block_dct, dequantize, unzigzag]
+
+
+
+# steps that treat every row of blocks on its own, so a channel can be cut into bands of block rows and processed in parallel
+BLOCK_ROW_STEPS = {calculate_blocked_dct, inverse_block_dct, quantize, dequantize, zigzag, unzigzag, fused_encode}
+
+
+
+def block_row_bands(channel, bands, **kwargs):
+    # yields (band, kwargs) for about `bands` runs of block rows, each with the rows of q_array that belong to it
+    block_size = kwargs['block_size']
+    factors = calculate_downsampling_ratios(kwargs["downsample_ratio"])[kwargs["index"]]
+    unit = block_size if channel.ndim == 2 else 1 # channel rows per row of blocks, fused_encode takes pixels
+
+    rows = channel.shape[0] // unit
+    step = -(-rows // bands)
+
+    for row in range(0, rows, step):
+        band_kwargs = dict(kwargs)
+        if kwargs['dynamic']:
+            band_kwargs['q_array'] = kwargs['q_array'][row * factors[1]:(row + step) * factors[1]]
+
+        yield channel[row * unit:(row + step) * unit], band_kwargs
 
-    return channel_reconstructed    
 
 
 # ------ deprecated for now
@@ -0,0 +1,127 @@
+"""
+Batch encoder: compresses every image in a directory (or matching a glob) with a process pool.
+
+    python compress.py images/ -o compressed/ -q 50 --downsample-ratio 4:2:0 --dmode std_LoG
+
+Each image is written to <output>/<file name>.zst (a.jpg -> a.jpg.zst) as soon as its worker finishes, with one
+line of throughput (megapixels per second) and compression ratio printed per image.  Sources whose file names
+collide are refused up front, an image that fails to encode is reported and the rest carry on, and the exit
+status is 1 if any failed.
+"""
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+import numpy as np
+import skimage.io as skio
+import jpeg_class
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+DMODES = ("std_LoG", "mean_LoG", "std_saliency", "mean_saliency", "std_dct", "mean_dct")
+
+
+
+def find_images(sources):
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            names = sorted(os.listdir(source))
+            paths += [os.path.join(source, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            paths += sorted(glob.glob(source))
+
+    return paths
+
+
+
+def read_rgb(path):
+    img = skio.imread(path)
+
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+
+    return img[..., :3] # drop alpha
+
+
+
+def output_path(path, output):
+    # the extension stays in the name, a.jpg and a.png don't overwrite each other
+    return os.path.join(output, os.path.basename(path) + ".zst")
+
+
+
+def encode_file(path, output, q, downsample_ratio, dMode):
+    start = time.perf_counter()
+
+    img = read_rgb(path)
+    jpeg = jpeg_class.JPEG(img, q, downsample_ratio = downsample_ratio, dynamic = bool(dMode), dMode = dMode)
+    jpeg.encode()
+
+    out_path = output_path(path, output)
+    jpeg.save_image(out_path)
+
+    return path, out_path, img.shape[0] * img.shape[1], img.nbytes, os.path.getsize(out_path), time.perf_counter() - start
+
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Compress a batch of images in parallel.")
+    parser.add_argument("sources", nargs = "+", help = "directories or glob patterns of images to compress")
+    parser.add_argument("-o", "--output", default = ".", help = "directory for the .zst files")
+    parser.add_argument("-q", "--quality", type = float, default = 50, help = "quality between 0 and 100")
+    parser.add_argument("--downsample-ratio", default = "4:2:0", choices = ("4:2:0", "4:2:2", "4:4:4", "4:1:1"))
+    parser.add_argument("--dmode", default = None, choices = DMODES, help = "saliency measure for dynamic quantization")
+    parser.add_argument("-j", "--workers", type = int, default = os.cpu_count(), help = "worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    paths = find_images(args.sources)
+    if not paths:
+        parser.error("no images found")
+
+    seen = {}
+    for path in paths:
+        out_path = output_path(path, args.output)
+        if out_path in seen:
+            parser.error(f"{seen[out_path]} and {path} would both be written to {out_path}")
+        seen[out_path] = path
+
+    os.makedirs(args.output, exist_ok = True)
+
+    total_pixels = total_raw = total_compressed = 0
+    failed = []
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = args.workers) as pool:
+        futures = {pool.submit(encode_file, path, args.output, args.quality, args.downsample_ratio, args.dmode): path for path in paths}
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                path, out_path, pixels, raw, compressed, seconds = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"{futures[future]}: failed, {type(e).__name__}: {e}", file = sys.stderr, flush = True)
+                continue
+            total_pixels += pixels
+            total_raw += raw
+            total_compressed += compressed
+            print(f"{path} -> {out_path}: {pixels / 1e6 / seconds:.2f} MP/s, ratio {raw / compressed:.1f}x", flush = True)
+
+    elapsed = time.perf_counter() - start
+    done = len(paths) - len(failed)
+    ratio = f"{total_raw / total_compressed:.1f}x" if total_compressed else "-"
+    print(f"{done} images, {total_pixels / 1e6 / elapsed:.2f} MP/s overall, ratio {ratio}")
+
+    if failed:
+        print(f"{len(failed)} of {len(paths)} images failed: {', '.join(sorted(failed))}", file = sys.stderr)
+        return 1
+
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
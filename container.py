@@ -0,0 +1,368 @@
+import functools
+import mmap
+import struct
+import threading
+import numpy as np
+import zstd
+import entropy
+
+
+# Binary container for encoded JPEG objects, replaces pickle + zstd so loading never executes code.
+#
+# layout (all little endian):
+#   magic, version
+#   header: q, block_size, dynamic, image height/width, downsample ratio string
+#   q_array: rows, cols, zstd compressed uint8 map (rows = cols = 0 when not dynamic)
+#   channel shapes: (block rows, block columns, coefficients per block) for Y, Cb, Cr
+#   chunks: independently coded runs of block rows, one channel each
+#   index: one entry per chunk (channel, first block row, number of rows, codec, offset, length)
+#   trailer: offset of the index, magic
+# the index sits at the end so chunks can be written out as soon as they are ready.
+
+MAGIC = b"CZIP"
+VERSION = 1
+
+CHANNELS = ("Y", "Cb", "Cr")
+
+# chunk codecs
+EOB_ZSTD = 1 # per block end-of-block truncation of the zigzag vector, then zstd (huffman/FSE) over the stream
+HUFFMAN = 2 # JPEG style DPCM + (run, size) symbols and runs of empty blocks, canonical DC and AC huffman tables per chunk, see entropy.py
+EOB_ZSTD_DICT = 3 # EOB_ZSTD with a shared trained dictionary, which has to be passed in again to load
+
+# zstd dictionaries need the zstandard package, imported only when one is used
+DICTIONARY_SIZE = 4096
+
+_PREAMBLE = struct.Struct("<4sB")
+_HEADER = struct.Struct("<dH?IIB")
+_Q_ARRAY = struct.Struct("<III")
+_CHANNEL = struct.Struct("<III")
+_INDEX_ENTRY = struct.Struct("<BIIBQI")
+_TRAILER = struct.Struct("<Q4s")
+
+
+def _eob_dtype(n):
+    # end of block position goes up to n inclusive
+    return np.uint8 if n < 256 else np.uint16
+
+
+
+def _kept_positions(eob, n):
+    # flat positions of the first eob[k] coefficients of every block k, without building a full boolean mask:
+    # the k-th kept value sits at k plus the offset of its block (block start minus values before it)
+    starts = np.cumsum(eob) - eob
+    return np.arange(eob.sum()) + np.repeat(np.arange(0, len(eob) * n, n) - starts, eob)
+
+
+
+def _eob_payload(blocks):
+    # blocks is (rows, cols, n) int8 zigzag vectors
+    n = blocks.shape[-1]
+    flat = blocks.reshape(-1, n)
+
+    # position one past the last nonzero coefficient in every block, everything after is an implicit run of zeros
+    nonzero = flat != 0
+    eob = n - np.argmax(nonzero[:, ::-1], axis=1)
+    eob[~nonzero.any(axis=1)] = 0
+
+    values = flat.ravel()[_kept_positions(eob, n)]
+
+    return eob.astype(_eob_dtype(n)).tobytes() + values.astype(np.int8).tobytes()
+
+
+
+def _eob_blocks(payload, shape, out = None):
+    # out, if given, is a zeroed C contiguous array of shape to decode into instead of a new one
+    rows, cols, n = shape
+
+    eob_dtype = _eob_dtype(n)
+    eob_bytes = rows * cols * np.dtype(eob_dtype).itemsize
+    eob = np.frombuffer(payload, dtype=eob_dtype, count=rows * cols)
+    values = np.frombuffer(payload, dtype=np.int8, offset=eob_bytes)
+
+    blocks = np.zeros(shape, dtype=np.int8) if out is None else out
+    blocks.reshape(-1)[_kept_positions(eob.astype(np.intp), n)] = values
+
+    return blocks
+
+
+
+# level and threads go straight to zstd, threads = 0 lets it pick from the number of cores
+def encode_coefficients(blocks, level = 3, threads = 0, **kwargs):
+    return zstd.compress(_eob_payload(blocks), level, threads)
+
+
+
+def decode_coefficients(data, shape, out = None, **kwargs):
+    # the zstd binding only takes bytes, a view of a mapped file is copied here
+    return _eob_blocks(zstd.decompress(bytes(data)), shape, out)
+
+
+
+def _per_thread(function):
+    # caches function's results like functools.lru_cache, but separately for every thread.  zstandard
+    # compressors and decompressors must not be used from several threads at once, so none is shared
+    local = threading.local()
+
+    @functools.wraps(function)
+    def cached(*args):
+        if not hasattr(local, "cache"):
+            local.cache = {}
+        if args not in local.cache:
+            local.cache[args] = function(*args)
+
+        return local.cache[args]
+
+    return cached
+
+
+
+# compressors and decompressors are cached, loading a dictionary costs more than compressing a small chunk with it.
+# dictionary frames are written without magic number, dictionary id and checksum: chunks of small images are
+# only tens of bytes, and those fields alone made them bigger than the uncompressed payload
+@_per_thread
+def _dictionary_compressor(dictionary, level, threads):
+    import zstandard # only needed for dictionaries
+
+    # zstandard counts threads differently, 0 means no worker threads and -1 one per core
+    params = zstandard.ZstdCompressionParameters.from_level(level, format = zstandard.FORMAT_ZSTD1_MAGICLESS,
+                                                            write_dict_id = False, write_checksum = False,
+                                                            threads = -1 if threads == 0 else threads)
+
+    return zstandard.ZstdCompressor(dict_data = zstandard.ZstdCompressionDict(dictionary), compression_params = params)
+
+
+
+@_per_thread
+def _dictionary_decompressor(dictionary):
+    import zstandard # only needed for dictionaries
+
+    return zstandard.ZstdDecompressor(dict_data = zstandard.ZstdCompressionDict(dictionary), format = zstandard.FORMAT_ZSTD1_MAGICLESS)
+
+
+
+def encode_coefficients_dictionary(blocks, dictionary = None, level = 3, threads = 0, **kwargs):
+    if dictionary is None:
+        raise ValueError("EOB_ZSTD_DICT chunks need a dictionary, see train_dictionary")
+
+    return _dictionary_compressor(bytes(dictionary), level, threads).compress(_eob_payload(blocks))
+
+
+
+def decode_coefficients_dictionary(data, shape, dictionary = None, out = None, **kwargs):
+    if dictionary is None:
+        raise ValueError("file was saved with a zstd dictionary, pass the same dictionary to load it")
+
+    return _eob_blocks(_dictionary_decompressor(bytes(dictionary)).decompress(data), shape, out)
+
+
+
+CHUNK_ENCODERS = {EOB_ZSTD: encode_coefficients, HUFFMAN: entropy.encode, EOB_ZSTD_DICT: encode_coefficients_dictionary}
+CHUNK_DECODERS = {EOB_ZSTD: decode_coefficients, HUFFMAN: entropy.decode, EOB_ZSTD_DICT: decode_coefficients_dictionary}
+
+
+
+def train_dictionary(states, size = DICTIONARY_SIZE, chunk_rows = 32):
+    """
+    Trains a zstd dictionary on the coefficient chunks of a sample of encoded images (states as from
+    JPEG.__getstate__).  Worth it for corpora of small images, where every file on its own is too short
+    for zstd to learn much.  Returns the dictionary as bytes, store it and pass it to dump/load.
+    """
+    import zstandard # only needed for dictionaries
+
+    samples = [_eob_payload(state[name][row:row + chunk_rows])
+               for state in states for name in CHANNELS for row in range(0, state[name].shape[0], chunk_rows)]
+
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+
+def write_header(f, state):
+    ratio = state['downsample_ratio'].encode("ascii")
+    height, width = state['shape']
+
+    f.write(_PREAMBLE.pack(MAGIC, VERSION))
+    f.write(_HEADER.pack(state['q'], state['block_size'], bool(state['dynamic']), height, width, len(ratio)))
+    f.write(ratio)
+
+    q_array = state['q_array']
+    if q_array is None:
+        f.write(_Q_ARRAY.pack(0, 0, 0))
+    else:
+        compressed = zstd.compress(np.ascontiguousarray(q_array, dtype=np.uint8).tobytes())
+        f.write(_Q_ARRAY.pack(q_array.shape[0], q_array.shape[1], len(compressed)))
+        f.write(compressed)
+
+    for shape in state['channel_shapes']:
+        f.write(_CHANNEL.pack(*shape))
+
+
+
+def read_header(f):
+    magic, version = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+    if magic != MAGIC:
+        raise ValueError("not a compressed image file")
+    if version != VERSION:
+        raise ValueError(f"unsupported container version {version}")
+
+    q, block_size, dynamic, height, width, ratio_length = _HEADER.unpack(f.read(_HEADER.size))
+    ratio = f.read(ratio_length).decode("ascii")
+
+    rows, cols, length = _Q_ARRAY.unpack(f.read(_Q_ARRAY.size))
+    q_array = None
+    if length:
+        q_array = np.frombuffer(zstd.decompress(f.read(length)), dtype=np.uint8).reshape(rows, cols)
+
+    channel_shapes = [_CHANNEL.unpack(f.read(_CHANNEL.size)) for _ in CHANNELS]
+
+    return {'q': int(q) if q.is_integer() else q, 'block_size': block_size,
+            'downsample_ratio': ratio, 'dynamic': dynamic, 'q_array': q_array,
+            'shape': (height, width), 'channel_shapes': channel_shapes}
+
+
+
+# options (level, threads, dictionary) are passed on to the chunk encoder, which ignores what it doesn't use
+def write_chunk(f, index, channel, row, blocks, codec = EOB_ZSTD, **options):
+    data = CHUNK_ENCODERS[codec](blocks, **options)
+    index.append((channel, row, blocks.shape[0], codec, f.tell(), len(data)))
+    f.write(data)
+
+
+
+def write_index(f, index):
+    offset = f.tell()
+    f.write(struct.pack("<I", len(index)))
+    for entry in index:
+        f.write(_INDEX_ENTRY.pack(*entry))
+    f.write(_TRAILER.pack(offset, MAGIC))
+
+
+
+def read_index(f):
+    f.seek(-_TRAILER.size, 2)
+    offset, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError("truncated compressed image file")
+
+    f.seek(offset)
+    count, = struct.unpack("<I", f.read(4))
+    return [_INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size)) for _ in range(count)]
+
+
+
+def dump(f, state, chunk_rows = 32, codec = EOB_ZSTD, **options):
+    """
+    Writes the state of an encoded JPEG (as returned by JPEG.__getstate__) to an open binary file.
+    Every channel is split into chunks of chunk_rows block rows that are coded independently with codec
+    and written out straight away, so only one chunk is ever held compressed.
+    options are level and threads for zstd and dictionary (from train_dictionary), which turns EOB_ZSTD into EOB_ZSTD_DICT.
+    """
+    if codec == EOB_ZSTD and options.get('dictionary') is not None:
+        codec = EOB_ZSTD_DICT
+
+    channels = [state[name] for name in CHANNELS]
+    for channel in channels:
+        if channel is None or channel.ndim != 3:
+            raise ValueError("image must be fully encoded before it can be saved")
+
+    write_header(f, {**state, 'channel_shapes': [channel.shape for channel in channels]})
+
+    index = []
+    for c, channel in enumerate(channels):
+        for row in range(0, channel.shape[0], chunk_rows):
+            write_chunk(f, index, c, row, channel[row:row + chunk_rows], codec, **options)
+
+    write_index(f, index)
+
+
+
+def _chunk(f, offset, length):
+    # a mapped file hands out a view of the chunk, anything else reads it
+    if isinstance(f, memoryview):
+        return f[offset:offset + length]
+
+    f.seek(offset)
+    return f.read(length)
+
+
+
+def read_channel(f, index, c, shape, rows = None, dictionary = None):
+    """
+    Decodes channel number c (of the given (block rows, block columns, n) shape) from the chunks in index.
+    f is an open binary file or a memoryview of a whole mapped file.
+    rows optionally gives a (first, last) block row range, chunks outside of it are skipped and left as zeros.
+    dictionary is only needed for EOB_ZSTD_DICT chunks.
+    """
+    rows_shape, cols, n = shape
+    # zeros are only committed to memory where a chunk is actually written
+    channel = np.zeros((rows_shape, cols, n), dtype=np.int8)
+    first, last = (0, rows_shape) if rows is None else rows
+
+    for entry_channel, row, nrows, codec_id, offset, length in index:
+        if entry_channel != c or row >= last or row + nrows <= first:
+            continue
+        if codec_id not in CHUNK_DECODERS:
+            raise ValueError(f"unknown chunk codec {codec_id}")
+
+        # decoders write straight into the rows of channel (already zero) rather than into an array of their own
+        CHUNK_DECODERS[codec_id](_chunk(f, offset, length), (nrows, cols, n), dictionary = dictionary, out = channel[row:row + nrows])
+
+    return channel
+
+
+
+def load(f, rows = None, dictionary = None):
+    """
+    Reads a file written by dump back into a state dictionary for JPEG.__setstate__.
+    rows optionally gives a (first, last) block row range per channel, chunks outside of it are
+    never decompressed and their blocks are left as zeros.  dictionary has to be the one it was dumped with, if any.
+    """
+    state = read_header(f)
+    index = read_index(f)
+
+    for c, name in enumerate(CHANNELS):
+        state[name] = read_channel(f, index, c, state['channel_shapes'][c], None if rows is None else rows[c], dictionary)
+
+    del state['channel_shapes']
+    return state
+
+
+
+class MappedFile:
+    """
+    A saved image read lazily.  Opening it only parses the header and the chunk index, with a plain read;
+    the file is memory mapped the first time a channel is asked for, and that channel's chunks are decoded
+    straight out of the mapping.  close() (or leaving a with block) unmaps it again, a mapping holds a file
+    descriptor of its own.  Asking for a channel after closing maps the file again.
+    """
+    def __init__(self, filename, dictionary = None):
+        self.filename = filename
+        self.dictionary = dictionary
+        self.map = None
+
+        with open(filename, 'rb') as f:
+            self.header = read_header(f)
+            self.index = read_index(f)
+
+
+    def channel(self, name, rows = None):
+        if self.map is None:
+            with open(self.filename, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        c = CHANNELS.index(name)
+        with memoryview(self.map) as view:
+            return read_channel(view, self.index, c, self.header['channel_shapes'][c], rows, self.dictionary)
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
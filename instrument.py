@@ -0,0 +1,59 @@
+import contextlib
+import json
+import time
+import tracemalloc
+
+
+class Report:
+    """
+    Collects wall time, CPU time and peak allocation for named stages, optionally per channel.
+    Peak allocation comes from tracemalloc (numpy reports its buffers to it), which slows the run
+    down noticeably, so it can be switched off with memory = False.
+    """
+    def __init__(self, memory = True):
+        self.memory = memory
+        self.records = []
+
+
+    @contextlib.contextmanager
+    def measure(self, stage, channel = None):
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {"stage": stage, "channel": channel,
+                      "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu}
+            if self.memory:
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+            if started_tracing:
+                tracemalloc.stop()
+
+            self.records.append(record)
+
+
+    def totals(self):
+        # records of the same stage summed over channels, peak is the largest of them
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"wall_s": 0.0, "cpu_s": 0.0, "peak_bytes": 0})
+            total["wall_s"] += record["wall_s"]
+            total["cpu_s"] += record["cpu_s"]
+            total["peak_bytes"] = max(total["peak_bytes"], record.get("peak_bytes", 0))
+
+        return totals
+
+
+    def as_dict(self):
+        return {"stages": self.records, "totals": self.totals()}
+
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
@@ -1,68 +1,165 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage.io as skio
-import scipy
-import rle
-import zstd
-import os
-import pickle
-from skimage.util import view_as_blocks
-from skimage.color import rgb2ycbcr, ycbcr2rgb
+import contextlib
+import concurrent.futures
+import functools
 import saliency
 import codec
+import container
+import instrument
+import cache
 
-import importlib
-importlib.reload(codec)
-importlib.reload(saliency)
 
 
 
+CHANNEL_NAMES = ["Y", "Cb", "Cr"]
+
+
+
+# the DCT modes reuse the encoder's blocked luma DCT instead of transforming again (see unshifted_dct), so their
+# q_arrays are of the YCbCr luma, not of skimage's rgb2gray the standalone saliency views use: different weights
+# and a 16..235 range.  against the baseline on the top left 512x496 of images/ryan.jpg that still moves 3879
+# (std_dct) and 3878 (mean_dct) of 3968 blocks, by 5.0 / 5.1 levels on average and 13 at most
+DCT_DMODES = ("std_dct", "mean_dct")
+
+# parameters every saliency view is run with, they are part of the cache key as well
+SALIENCY_PARAMS = {"std_LoG": {"sigma": 5}, "mean_LoG": {"sigma": 5}, "std_saliency": {"mode": "FG"}, "mean_saliency": {"mode": "FG"}}
+
+# saliency maps only depend on the pixels and the view, so encoding one image at many qualities computes its map once
+# swap in cache.ArrayCache(directory = ...) to keep maps between runs, or None to always recompute
+SALIENCY_CACHE = cache.ArrayCache()
+
+
+
+# the encoder's luma DCT is of Y - 0.5, the DCT views are of the image as it is: a copy with the shift put
+# back into every DC (a constant c adds 4 * block_size^2 * c there in the unnormalized DCT)
+def unshifted_dct(dct):
+    dct = np.array(dct, dtype=np.float64)
+    dct[..., 0, 0] += 0.5 * 4 * dct.shape[-1] * dct.shape[-2]
+
+    return dct
+
+
+
+# saliency measure picked by dMode for one image, the DCT modes use dct (its blocked luma DCT) when given
+def saliency_view(img_array, dMode, dct = None):
+    params = SALIENCY_PARAMS.get(dMode, {})
+
+    if dMode == "std_LoG":
+        return saliency.std_LoG_view(img_array, **params)
+    elif dMode == "mean_LoG":
+        return saliency.mean_LoG_view(img_array, **params)
+    elif dMode == "std_saliency":
+        return saliency.std_saliency_view(img_array, **params)
+    elif dMode == "mean_saliency":
+        return saliency.mean_saliency_view(img_array, **params)
+    elif dMode == "std_dct":
+        return saliency.std_dct_view(img_array, dct = None if dct is None else unshifted_dct(dct))
+    elif dMode == "mean_dct":
+        return saliency.mean_dct_view(img_array, dct = None if dct is None else unshifted_dct(dct))
+    else:
+        return None
+
+
+
+# saliency_view through SALIENCY_CACHE, compute is only called on a miss
+# the DCT views come out slightly different in float32 or from another DCT backend, so both go into the key
+def cached_saliency_view(img_array, dMode, compute, dtype = np.float64, dct_backend = codec.DEFAULT_DCT_BACKEND):
+    if SALIENCY_CACHE is None or dMode not in SALIENCY_PARAMS and dMode not in DCT_DMODES:
+        return compute()
+
+    params = dict(SALIENCY_PARAMS.get(dMode, {}), dtype = np.dtype(dtype).str if dMode in DCT_DMODES else None,
+                  dct_backend = dct_backend if dMode in DCT_DMODES else None)
+    key = cache.content_key(img_array, dMode = dMode, **params)
+
+    return SALIENCY_CACHE.get_or_compute(key, compute)
+
+
+
+# one pool per thread count shared by every JPEG, numpy and scipy let go of the GIL inside their kernels
+@functools.lru_cache
+def thread_pool(threads):
+    return concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+
+
 
 class JPEG:
-    def __init__(self, img_array, q, block_size = 8, downsample_ratio = "4:2:0", dynamic = False, dMode = False):
+    # precision "float32" keeps Y/Cb/Cr, the DCT and dequantization in single precision instead of float64.
+    # parity check, codec.psnr of the decode against the original for images/ryan.jpg at q 50 (dct_backend "fftpack"):
+    #   static:           float64 24.6714 dB, float32 24.6714 dB
+    #   dynamic std_LoG:  float64 22.9208 dB, float32 22.9219 dB
+    # the quantized coefficients came out identical, they can only differ by one where a value sits right at a rounding edge
+    # fused = True runs blocking, DCT, quantizing and zigzagging as one banded pass per channel (codec.fused_encode)
+    # profile = True records time and memory of every stage into self.report (see instrument.py)
+    # threads > 1 runs the channels, and bands of block rows within them, concurrently on a shared thread pool
+    # dct_backend is one of codec.DCT_BACKENDS or "auto" for the fastest on this machine, dct_workers the threads the "scipy" backend uses
+    # auto is settled here, once, so every stage and thread of this image uses the same backend
+    def __init__(self, img_array, q, block_size = 8, downsample_ratio = "4:2:0", dynamic = False, dMode = False, precision = "float64", fused = False,
+                 profile = False, threads = 1, dct_backend = codec.DEFAULT_DCT_BACKEND, dct_workers = 1):
         # could have sensitivity to saliency be a parameter
         # could have type of saliency be a parameter
-        self.img_array = img_array
+        self.shape = img_array.shape[:2]
+        self.img_array = codec.pad_to_mcu(img_array, block_size, downsample_ratio) # any size works, decode crops back to shape
         self.block_size = block_size
         self.downsample_ratio = downsample_ratio
         self.dynamic = dynamic
         self.dMode = dMode
+        self.dtype = np.dtype(precision)
+        self.fused = fused
+        self.threads = threads
+        self.dct_backend = codec.resolve_dct_backend(dct_backend, block_size, self.dtype, dct_workers)
+        self.dct_workers = dct_workers
+        self.luma_dct = None
+        self.report = instrument.Report() if profile else None
 
 
         # how is dynamic quantization going to work?  channel wise or should i do it with a single grayscale array
         # probably that, would save the most space
         # how to deal with downsampling in Cb and Cr channels?
-        if dynamic:
-            if dMode == "std_LoG":
-                self.q_array = saliency.std_LoG_view(img_array)
-            elif dMode == "mean_LoG":
-                self.q_array = saliency.mean_LoG_view(img_array)
-            elif dMode == "std_saliency":
-                self.q_array = saliency.std_saliency_view(img_array)
-            elif dMode == "mean_saliency":
-                self.q_array = saliency.mean_saliency_view(img_array)
-            elif dMode == "std_dct":
-                self.q_array = saliency.std_dct_view(img_array)
-            elif dMode == "mean_dct":
-                self.q_array = saliency.mean_dct_view(img_array)
-            else:
-                self.q_array = None
-        else:
-            self.q_array = None
+        with self.measure("saliency_map"):
+            self.q_array = self.saliency_map() if dynamic else None
             
         self.q = q
         self.Y = None
         self.Cb = None
         self.Cr = None
 
+
+
+    # per block saliency measure picked by dMode, becomes the q_array for dynamic quantization
+    # on a cache hit the DCT modes skip their luma DCT too, encode then does it as usual
+    def saliency_map(self):
+        def compute():
+            if self.dMode in DCT_DMODES:
+                self.luma_dct = self.blocked_luma_dct()
+
+            return saliency_view(self.img_array, self.dMode, self.luma_dct)
+
+        return cached_saliency_view(self.img_array, self.dMode, compute, self.dtype, self.dct_backend)
+
+
+
+    # context manager timing a stage into self.report, does nothing unless profiling
+    # set self.report = instrument.Report() on a loaded image to profile its decode
+    def measure(self, stage, channel = None):
+        if self.report is None:
+            return contextlib.nullcontext()
+
+        return self.report.measure(stage, channel)
+
+
    
     # makes/displays img array
+    # matplotlib only gets imported for these, a headless encode never loads it
     def show_image(self):
+        import matplotlib.pyplot as plt
+
         plt.imshow(self.img_array)
 
             
     
     def compare_image(self, img):
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(1, 2)
         fig.set_figheight(12)
         fig.set_figwidth(15)
@@ -76,6 +173,8 @@ class JPEG:
 
     
     def compare_slice(self, img, start = 50, end = 75):
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(1, 2)
         fig.set_figheight(12)
         fig.set_figwidth(15)
@@ -95,67 +194,276 @@ class JPEG:
     
     # ripped this straight from Claude...
     # we can batch apply our functions now, channel wise (less for loops in function)
-    def process_channels(self, function, **kwargs):
+    # channels with their index in skip are passed through untouched
+    def process_channels(self, function, skip = (), **kwargs):
         channels = [self.Y, self.Cb, self.Cr]
         processed_channels = []
 
+        if self.threads > 1:
+            with self.measure(function.__name__):
+                self.Y, self.Cb, self.Cr = self.process_channels_threaded(function, channels, skip, kwargs)
+            return
+
         for i, channel in enumerate(channels):
-            processed_channel = function(channel, **kwargs, index = i) # need to pass through all the stuff we might need
+            if i in skip:
+                processed_channels.append(channel)
+                continue
+            with self.measure(function.__name__, CHANNEL_NAMES[i]):
+                processed_channel = function(channel, **kwargs, index = i) # need to pass through all the stuff we might need
             processed_channels.append(processed_channel)
 
         self.Y, self.Cb, self.Cr = processed_channels
 
 
     
+    # every channel (split into bands of block rows when the step allows it) becomes a task on the shared pool
+    # stages are only timed as a whole here, per channel numbers would overlap
+    def process_channels_threaded(self, function, channels, skip, kwargs):
+        pool = thread_pool(self.threads)
+        tasks = []
+
+        for i, channel in enumerate(channels):
+            if i in skip:
+                tasks.append(channel)
+            elif function in codec.BLOCK_ROW_STEPS:
+                bands = codec.block_row_bands(channel, self.threads, **kwargs, index = i)
+                tasks.append([pool.submit(function, band, **band_kwargs) for band, band_kwargs in bands])
+            else:
+                tasks.append([pool.submit(function, channel, **kwargs, index = i)])
+
+        processed_channels = []
+        for task in tasks:
+            if not isinstance(task, list):
+                processed_channels.append(task)
+                continue
+
+            parts = [future.result() for future in task]
+            processed_channels.append(parts[0] if len(parts) == 1 else np.concatenate(parts))
+
+        return processed_channels
+
+
+    
+    # Y after steps 1-4, the DCT saliency modes need it for the q_array so encode can reuse it
+    def blocked_luma_dct(self):
+        Y, _, _ = codec.rgb_to_YCbCr(self.img_array, self.dtype)
+        kwargs = {"block_size": self.block_size, "index": 0, "dct_backend": self.dct_backend, "dct_workers": self.dct_workers}
+
+        return codec.calculate_blocked_dct(codec.form_blocks(Y, **kwargs), **kwargs)
+
+
+    
     # 1. rgb_2_ycbcr, 2. downsampling, 3. blocking, 4. DCT, 5. quantizing, 6. zigzagging
     def encode(self, max_step = 6):
         
-        self.Y, self.Cb, self.Cr = codec.rgb_to_YCbCr(self.img_array)
+        with self.measure("rgb_to_YCbCr"):
+            self.Y, self.Cb, self.Cr = codec.rgb_to_YCbCr(self.img_array, self.dtype)
         
-        functions = [codec.downscale_colors, codec.form_blocks, codec.calculate_blocked_dct, codec.quantize, codec.zigzag]
+        functions = codec.ENCODE_STEPS[: max_step - 1]
+        if self.fused and max_step == 6:
+            functions = [codec.downscale_colors, codec.fused_encode]
         kwargs = {"block_size": self.block_size, "q": self.q, "downsample_ratio": self.downsample_ratio, 
-                  "dynamic": self.dynamic, "q_array": self.q_array, "dMode": self.dMode}
+                  "dynamic": self.dynamic, "q_array": self.q_array, "dMode": self.dMode, "dtype": self.dtype,
+                  "dct_backend": self.dct_backend, "dct_workers": self.dct_workers}
+
+        # luma DCT already done while building the q_array, only chroma still has to be blocked and transformed
+        luma_dct = self.luma_dct if max_step >= 4 else None
         
-        for f in functions[: max_step - 1]:
-            self.process_channels(f, **kwargs)
+        for f in functions:
+            if luma_dct is not None and f is codec.fused_encode:
+                self.Y = luma_dct # fused_encode starts transformed channels at quantizing
+                self.luma_dct = None
+
+            if luma_dct is not None and f in (codec.form_blocks, codec.calculate_blocked_dct):
+                self.process_channels(f, skip = (0,), **kwargs)
+            else:
+                self.process_channels(f, **kwargs)
+
+            if luma_dct is not None and f is codec.calculate_blocked_dct:
+                self.Y = luma_dct
+                self.luma_dct = None
 
     
     
-    def decode(self, from_step = 6):
+    # normalize = True stretches the output to its own min/max like the original decoder did
+    def decode(self, from_step = 6, normalize = False):
 
-        functions = [codec.rescale_colors, codec.reconstruct_blocks, codec.inverse_block_dct, codec.dequantize, codec.unzigzag]
+        functions = codec.DECODE_STEPS
         kwargs = {"block_size": self.block_size, "q": self.q, "downsample_ratio": self.downsample_ratio, 
-                  "dynamic": self.dynamic, "q_array": self.q_array}
+                  "dynamic": self.dynamic, "q_array": self.q_array, "dtype": self.dtype,
+                  "dct_backend": self.dct_backend, "dct_workers": self.dct_workers}
         
         while from_step > 1:
             self.process_channels(functions[from_step - 2], **kwargs)
             from_step -= 1
 
-        self.img_array = codec.YCbCr_to_rgb([self.Y, self.Cb, self.Cr])
+        height, width = self.shape
+        with self.measure("YCbCr_to_rgb"):
+            self.img_array = codec.YCbCr_to_rgb([self.Y, self.Cb, self.Cr], normalize)[:height, :width]
+
+
+    # preview at 1 / scale of the full size from the stored coefficients, scale 8 uses only the DC of every block
+    # scale has to divide block_size (1, 2, 4 or 8 for 8x8 blocks)
+    # leaves Y, Cb and Cr as they are so a full decode can still follow
+    def decode_thumbnail(self, scale = 8):
+        if not (isinstance(scale, (int, np.integer)) and 0 < scale <= self.block_size and self.block_size % scale == 0):
+            raise ValueError(f"scale must divide the block size {self.block_size}, got {scale}")
+
+        kwargs = {"block_size": self.block_size, "q": self.q, "downsample_ratio": self.downsample_ratio, 
+                  "dynamic": self.dynamic, "q_array": self.q_array, "keep": self.block_size // scale, "dtype": self.dtype}
+
+        channels = []
+        for i, channel in enumerate([self.Y, self.Cb, self.Cr]):
+            reduced = codec.reduced_blocks(channel, **kwargs, index = i)
+            channels.append(codec.rescale_colors(reduced, **kwargs, index = i))
+
+        height, width = (-(-side // scale) for side in self.shape)
+        return codec.YCbCr_to_rgb(channels)[:height, :width]
 
 
+    
+    # decodes just the blocks covering the crop [y0:y1, x0:x1] of the image, the rest of every channel is never touched
+    def decode_region(self, x0, y0, x1, y1):
+        (top, left), blocks = codec.region_blocks(x0, y0, x1, y1, self.shape, self.block_size, self.downsample_ratio)
+
+        q_array = self.q_array
+        if self.dynamic:
+            rows, cols = blocks[0]
+            q_array = q_array[rows, cols]
+
+        kwargs = {"block_size": self.block_size, "q": self.q, "downsample_ratio": self.downsample_ratio, 
+                  "dynamic": self.dynamic, "q_array": q_array, "dtype": self.dtype,
+                  "dct_backend": self.dct_backend, "dct_workers": self.dct_workers}
+
+        channels = []
+        for i, channel in enumerate([self.Y, self.Cb, self.Cr]):
+            part = channel[blocks[i]]
+            for f in reversed(codec.DECODE_STEPS):
+                part = f(part, **kwargs, index = i)
+            channels.append(part)
+
+        return codec.YCbCr_to_rgb(channels)[y0 - top:y1 - top, x0 - left:x1 - left]
+
+
+    
     # saves to binary, compresses
-    def save_image(self, filename):
-        pickled_data = pickle.dumps(self)
-        compressed_data = zstd.compress(pickled_data)
-        with open(filename, 'wb') as f:
-            f.write(compressed_data)
+    # see container.py for the file layout, no pickle involved so loading can't run arbitrary code
+    # files are about half the size of the old pickle + zstd ones but load ~1.3x slower, expanding the end-of-block
+    # truncation costs more than it saves on decompressing (ryan.jpg at q 30: 4.1 ms against 3.3 ms, 25.9 against 49.0 kB)
+    # chunk_codec picks the entropy stage, container.EOB_ZSTD or container.HUFFMAN (JPEG style, entropy.py)
+    # HUFFMAN files come out 20-30% smaller, at the price of a few times slower saving and loading
+    # options go to container.dump: zstd level and threads, chunk_rows, and a dictionary from container.train_dictionary
+    def save_image(self, filename, chunk_codec = container.EOB_ZSTD, **options):
+        with self.measure("save_image"), open(filename, 'wb') as f:
+            container.dump(f, self.__getstate__(), codec = chunk_codec, **options)
 
     
-    def load_image(filename):
+    # lazy = True only reads the header and chunk index, Y, Cb and Cr are decoded out of a memory mapping of the
+    # file when first used, so opening an image just to look at q, shape or one channel costs next to nothing
+    # the mapping (and its file descriptor) is let go once all three channels are decoded
+    # images saved with a zstd dictionary need the same dictionary to load
+    def load_image(filename, lazy = False, dictionary = None):
+        if lazy:
+            mapped = container.MappedFile(filename, dictionary)
+
+            data = JPEG.__new__(JPEG)
+            data.__setstate__({**mapped.header, 'Y': None, 'Cb': None, 'Cr': None})
+            del data.Y, data.Cb, data.Cr
+            data.mapped = mapped
+
+            return data
+
         with open(filename, 'rb') as f:
-            compressed = f.read()
-    
-        decompressed = zstd.decompress(compressed)
-        data = pickle.loads(decompressed)
+            state = container.load(f, dictionary = dictionary)
+
+        data = JPEG.__new__(JPEG)
+        data.__setstate__(state)
 
         return data
 
+
+
+    # only runs for attributes that aren't set, i.e. channels of a lazily loaded image not decoded yet
+    def __getattr__(self, name):
+        mapped = self.__dict__.get('mapped')
+        if mapped is None or name not in CHANNEL_NAMES:
+            raise AttributeError(f"'JPEG' object has no attribute '{name}'")
+
+        channel = mapped.channel(name)
+        setattr(self, name, channel)
+
+        if all(channel_name in self.__dict__ for channel_name in CHANNEL_NAMES):
+            mapped.close()
+            del self.mapped
+
+        return channel
+
+
+    
+    # encodes a stack of same sized images, (N, H, W, 3), and returns N encoded JPEGs
+    # every encode step runs once over the whole stack with N as a leading axis, so the per image python
+    # overhead and table setup is paid once per batch, which is most of the cost for small images
+    # the coefficients come out identical to JPEG(image, ...).encode() for each image
+    def encode_batch(images, q, block_size = 8, downsample_ratio = "4:2:0", dynamic = False, dMode = False, precision = "float64",
+                     dct_backend = codec.DEFAULT_DCT_BACKEND, dct_workers = 1):
+        images = np.asarray(images)
+        padded = codec.pad_to_mcu(images, block_size, downsample_ratio)
+        dtype = np.dtype(precision)
+        dct_backend = codec.resolve_dct_backend(dct_backend, block_size, dtype, dct_workers)
+
+        kwargs = {"block_size": block_size, "q": q, "downsample_ratio": downsample_ratio, 
+                  "dynamic": dynamic, "q_array": None, "dMode": dMode, "dtype": dtype,
+                  "dct_backend": dct_backend, "dct_workers": dct_workers}
+
+        # saliency is per image, the DCT modes wait for the batched luma DCT instead of transforming again
+        if dynamic and dMode not in DCT_DMODES:
+            kwargs["q_array"] = np.stack([cached_saliency_view(img, dMode, functools.partial(saliency_view, img, dMode)) for img in padded])
+
+        channels = codec.rgb_to_YCbCr(padded, dtype)
+        for f in codec.ENCODE_STEPS:
+            if dynamic and dMode in DCT_DMODES and f is codec.quantize:
+                kwargs["q_array"] = np.stack([cached_saliency_view(img, dMode, functools.partial(saliency_view, img, dMode, dct), dtype, dct_backend)
+                                              for img, dct in zip(padded, channels[0])])
+
+            channels = [f(channel, **kwargs, index = i) for i, channel in enumerate(channels)]
+
+        jpegs = []
+        for n in range(len(images)):
+            data = JPEG.__new__(JPEG)
+            data.__setstate__({'q': q, 'block_size': block_size, 'shape': images.shape[1:3],
+                               'downsample_ratio': downsample_ratio, 'dynamic': dynamic,
+                               'q_array': kwargs["q_array"][n] if dynamic else None,
+                               'Y': channels[0][n], 'Cb': channels[1][n], 'Cr': channels[2][n]})
+            data.img_array = padded[n]
+            data.dMode = dMode
+            data.dtype = dtype
+            data.dct_backend = dct_backend
+            data.dct_workers = dct_workers
+            jpegs.append(data)
+
+        return jpegs
+
+
+    
+    # crop of a saved image, only the chunks of the file that overlap it get decompressed
+    def load_region(filename, x0, y0, x1, y1, dictionary = None):
+        with open(filename, 'rb') as f:
+            header = container.read_header(f)
+            _, blocks = codec.region_blocks(x0, y0, x1, y1, header['shape'], header['block_size'], header['downsample_ratio'])
+
+            f.seek(0)
+            state = container.load(f, rows = [(rows.start, rows.stop) for rows, _ in blocks], dictionary = dictionary)
+
+        data = JPEG.__new__(JPEG)
+        data.__setstate__(state)
+
+        return data.decode_region(x0, y0, x1, y1)
+
     
     # use these to I only pickle what is necessary.  otherwise it wouldn't save space at all
     def __getstate__(self):
         # Return a dictionary containing only the attributes you want to pickle
-        return {'q': self.q, 'block_size': self.block_size, 
+        return {'q': self.q, 'block_size': self.block_size, 'shape': self.shape,
                 'downsample_ratio': self.downsample_ratio, 
                 'dynamic': self.dynamic, 'q_array': self.q_array,
                 'Y': self.Y, 'Cb': self.Cb, 'Cr': self.Cr}
@@ -166,6 +474,7 @@ class JPEG:
         # Restore the unpickled state
         self.q = state['q']
         self.block_size = state['block_size']
+        self.shape = state['shape']
         self.downsample_ratio = state['downsample_ratio']
         self.dynamic = state['dynamic']
         self.q_array = state['q_array']
@@ -173,3 +482,10 @@ class JPEG:
         self.Cb = state['Cb']
         self.Cr = state['Cr']
         self.img_array = None
+        self.dtype = np.dtype(np.float64)
+        self.fused = False
+        self.threads = 1
+        self.dct_backend = codec.DEFAULT_DCT_BACKEND
+        self.dct_workers = 1
+        self.luma_dct = None
+        self.report = None
@@ -1,18 +1,64 @@
-import matplotlib.pyplot as plt
-import cv2
-import scipy
-import ipywidgets as wdg
-import skimage.io as skio
-import skimage.util as skut
-import skimage.color as skolor
-import skimage.measure as skm
-import skimage.transform as skitran
-import skimage.exposure as ske
-import skimage.filters as skif
 import numpy as np
+import scipy.fft
+
+
+# plotting, skimage and cv2 are imported by the views that need them, so importing this module (and the codec) stays cheap
+
+
+# Block statistics
+# every view below reduces a full resolution map to one value per 8x8 tile.  reduceat sums each tile
+# in one pass straight at block resolution, tiles cut off by the image edge just have fewer pixels
+
+def block_sums(arr, block_size = 8):
+    """
+    Returns (sums, pixel counts) of arr over block_size x block_size tiles.
+    """
+    rows = np.arange(0, arr.shape[0], block_size)
+    cols = np.arange(0, arr.shape[1], block_size)
+
+    sums = np.add.reduceat(np.add.reduceat(arr, rows, axis=0, dtype=np.float64), cols, axis=1)
+    counts = np.outer(np.diff(rows, append=arr.shape[0]), np.diff(cols, append=arr.shape[1]))
+
+    return sums, counts
+
+
+def block_mean(arr, block_size = 8):
+    """
+    Mean of arr over block_size x block_size tiles, one value per tile.
+    """
+    sums, counts = block_sums(arr, block_size)
+
+    return sums / counts
+
+
+def block_std(arr, block_size = 8):
+    """
+    Standard deviation of arr over block_size x block_size tiles, one value per tile.
+    """
+    sums, counts = block_sums(arr, block_size)
+    squares, _ = block_sums(np.square(arr, dtype=np.float64), block_size)
+    mean = sums / counts
+
+    return np.sqrt(np.maximum(squares / counts - mean ** 2, 0))
+
+
+def normalize_view(sliced):
+    """
+    Stretches a block statistic to the full uint8 range.
+    """
+    rang = sliced.max() - sliced.min()
+    sliced -= sliced.min()
+    sliced /= rang
+    sliced *= 255
+
+    return sliced.astype(np.uint8)
+
 
 
 def create_LoG(img, sigma, rToG = True):
+    import skimage.color as skolor
+    import skimage.filters as skif
+
     if rToG:
         img = skolor.rgb2gray(img)
     
@@ -25,10 +71,9 @@ def LoG_view(img, sigma, rToG = True):
     Displays 8x8 block LoG view of an image. If rToG is not False, will assume original image is RGB
     and convert to grayscale.
     """
-    if rToG:
-        img = skolor.rgb2gray(img)
-    
-    filtered = skif.difference_of_gaussians(img, sigma, channel_axis = -1)
+    import matplotlib.pyplot as plt
+
+    filtered = create_LoG(img, sigma, rToG)
 
     plt.figure()
     plt.imshow(filtered, cmap='gray')
@@ -42,20 +87,7 @@ def mean_LoG_view(img, sigma = 5, rToG = True):
     """
     LoG = create_LoG(img, sigma, rToG)
 
-    imsize = LoG.shape
-    mean_array = np.zeros(imsize)
-
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            mean_array[i:(i+8),j:(j+8)] = np.mean(LoG[i:(i+8), j:(j+8)])
-
-    sliced = mean_array[::8, ::8]
-
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
-    return sliced.astype(np.uint8)
+    return normalize_view(block_mean(LoG))
 
 def std_LoG_view(img, sigma = 5, rToG = True):
     """
@@ -64,22 +96,7 @@ def std_LoG_view(img, sigma = 5, rToG = True):
     """
     LoG = create_LoG(img, sigma, rToG)
 
-    imsize = LoG.shape
-    std_array = np.zeros(imsize)
-
-    # Do 8x8 DCT on image (in-place)
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            std_array[i:(i+8),j:(j+8)] = np.std(LoG[i:(i+8), j:(j+8)])
-
-    sliced = std_array[::8, ::8]
-
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
-    
-    return sliced.astype(np.uint8)
+    return normalize_view(block_std(LoG))
 
 
 
@@ -92,6 +109,8 @@ def create_saliency(img, mode = 'FG'):
 
     returns saliency map
     """
+    import cv2
+    
     if mode == 'SR':
         saliency = cv2.saliency.StaticSaliencySpectralResidual_create()
         (success, saliencyMap) = saliency.computeSaliency(img)
@@ -111,22 +130,7 @@ def mean_saliency_view(img, mode = 'FG'):
     """
     salMap = create_saliency(img, mode)
 
-    imsize = salMap.shape
-    mean_array = np.zeros(imsize)
-
-    # Do 8x8 DCT on image (in-place)
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            mean_array[i:(i+8),j:(j+8)] = np.mean(salMap[i:(i+8), j:(j+8)])
-    
-    sliced = mean_array[::8, ::8]
-
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
-
-    return sliced.astype(np.uint8)
+    return normalize_view(block_mean(salMap))
 
 def std_saliency_view(img, mode = 'FG'):
     """
@@ -134,69 +138,67 @@ def std_saliency_view(img, mode = 'FG'):
     """
     salMap = create_saliency(img, mode)
 
-    imsize = salMap.shape
-    std_array = np.zeros(imsize)
+    return normalize_view(block_std(salMap))
 
-    # Do 8x8 DCT on image (in-place)
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            std_array[i:(i+8),j:(j+8)] = np.std(salMap[i:(i+8), j:(j+8)])
-    
-    
-    sliced = std_array[::8, ::8]
-
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
+# DCT views
 
-    return sliced.astype(np.uint8)
+def _tile_dct_stat(region, tile, stat):
+    # batched DCT over every tile of region at once, then reduce each tile to a single value
+    rows, cols = region.shape[0] // tile[0], region.shape[1] // tile[1]
+    blocks = region.reshape(rows, tile[0], cols, tile[1]).swapaxes(1, 2)
+    return stat(scipy.fft.dctn(blocks, axes=(-2, -1)), axis=(-2, -1))
 
-# DCT views
 
-def mean_dct_view(img, rToG = True):
+def block_dct_stat(img, stat, block_size = 8):
     """
-    Takes an image as input, converts to grayscale from RGB (unless rToG is False)
-    And creates array which holds mean of DCT of image split into 8x8 blocks.
+    Applies stat (np.mean or np.std) to the DCT of every block_size x block_size tile of img.
+    Tiles cut off by the right and bottom edges are transformed at their own size.
     """
-    if rToG:
-        img = skolor.rgb2gray(img)
+    h, w = img.shape
+    rows, cols = h // block_size, w // block_size
+    h0, w0 = rows * block_size, cols * block_size
 
-    imsize = img.shape
-    mean_array = np.zeros(imsize)
+    out = np.empty((-(-h // block_size), -(-w // block_size)))
+    out[:rows, :cols] = _tile_dct_stat(img[:h0, :w0], (block_size, block_size), stat)
 
-    # Do 8x8 DCT on image (in-place)
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            mean_array[i:(i+8),j:(j+8)] = np.mean(scipy.fft.dctn(img[i:(i+8), j:(j+8)]))
-    
-    sliced = mean_array[::8, ::8]
+    if w0 < w:
+        out[:rows, cols] = _tile_dct_stat(img[:h0, w0:], (block_size, w - w0), stat)[:, 0]
+    if h0 < h:
+        out[rows, :cols] = _tile_dct_stat(img[h0:, :w0], (h - h0, block_size), stat)[0]
+    if h0 < h and w0 < w:
+        out[rows, cols] = _tile_dct_stat(img[h0:, w0:], (h - h0, w - w0), stat)[0, 0]
 
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
+    return out
 
-    return sliced.astype(np.uint8)
 
+def mean_dct_view(img, rToG = True, dct = None):
+    """
+    Takes an image as input, converts to grayscale from RGB (unless rToG is False)
+    And creates array which holds mean of DCT of image split into 8x8 blocks.
+    If dct (blocked DCT of shape (rows, cols, 8, 8), e.g. from codec.calculate_blocked_dct) is passed,
+    it is used directly and img is ignored.
+    """
+    if dct is not None:
+        return normalize_view(np.mean(dct, axis=(-2, -1)))
 
-def std_dct_view(img, rToG = True):
     if rToG:
+        import skimage.color as skolor
+
         img = skolor.rgb2gray(img)
 
-    imsize = img.shape
-    std_array = np.zeros(imsize)
+    return normalize_view(block_dct_stat(img, np.mean))
 
-    # Do 8x8 DCT on image (in-place)
-    for i in range(0, imsize[0], 8):
-        for j in range(0, imsize[1], 8):
-            std_array[i:(i+8),j:(j+8)] = np.std(scipy.fft.dctn(img[i:(i+8), j:(j+8)]))
-    
-    sliced = std_array[::8, ::8]
 
-    rang = sliced.max() - sliced.min()
-    sliced -= sliced.min()
-    sliced /= rang
-    sliced *= 255
+def std_dct_view(img, rToG = True, dct = None):
+    """
+    Same as mean_dct_view but with the standard deviation of each block's DCT.
+    """
+    if dct is not None:
+        return normalize_view(np.std(dct, axis=(-2, -1)))
 
-    return sliced.astype(np.uint8)
+    if rToG:
+        import skimage.color as skolor
+
+        img = skolor.rgb2gray(img)
+
+    return normalize_view(block_dct_stat(img, np.std))
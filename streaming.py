@@ -0,0 +1,96 @@
+"""
+Strip by strip encoding for images that don't fit in memory.
+
+The source only has to support row slicing (a numpy memmap works), so at any time just one
+horizontal strip of pixels and its coefficients are held.  Strips are a whole number of MCUs
+tall, so every strip runs through exactly the same steps as JPEG.encode.  Coefficients are held
+back until a whole chunk of chunk_rows block rows is ready, so every channel is cut into the same
+chunks JPEG.save_image writes and the file has the same size and decodes the same.  It isn't
+byte for byte the same file though: the channels' chunks come interleaved strip by strip where
+save_image writes one channel after the other.
+"""
+import os
+import numpy as np
+import codec
+import container
+
+
+
+def open_source(path, shape = None):
+    """
+    Memory maps an uncompressed image so pixels are only read when a strip touches them.
+    TIFFs are mapped with tifffile; anything else is treated as raw interleaved 8 bit RGB
+    and needs shape = (height, width).
+    """
+    if os.path.splitext(path)[1].lower() in (".tif", ".tiff"):
+        import tifffile # only needed for TIFF sources
+
+        return tifffile.memmap(path, mode = "r")
+
+    if shape is None:
+        raise ValueError("raw sources need shape = (height, width)")
+
+    return np.memmap(path, dtype = np.uint8, mode = "r", shape = (shape[0], shape[1], 3))
+
+
+
+def encode_stream(source, filename, q, block_size = 8, downsample_ratio = "4:2:0", q_array = None, strip_height = 256, precision = "float64",
+                  dct_backend = codec.DEFAULT_DCT_BACKEND, dct_workers = 1, chunk_codec = container.EOB_ZSTD, chunk_rows = 32, **options):
+    """
+    Encodes source (an (H, W, 3) array or memmap) into filename one strip at a time.
+    Passing a q_array (one value per 8x8 luma block, as from the saliency views) turns on dynamic quantization.
+    strip_height is rounded up to a whole number of MCUs, precision, dct_backend and dct_workers are as in JPEG,
+    chunk_codec, chunk_rows and options as in JPEG.save_image.
+    """
+    if chunk_codec == container.EOB_ZSTD and options.get('dictionary') is not None:
+        chunk_codec = container.EOB_ZSTD_DICT
+
+    height, width = source.shape[:2]
+    mcu_rows, mcu_cols = codec.mcu_size(block_size, downsample_ratio)
+    strip_height = -(-strip_height // mcu_rows) * mcu_rows
+
+    padded_height = -(-height // mcu_rows) * mcu_rows
+    padded_width = -(-width // mcu_cols) * mcu_cols
+    factors = codec.calculate_downsampling_ratios(downsample_ratio)
+    channel_shapes = [(padded_height // f[1] // block_size, padded_width // f[0] // block_size, block_size ** 2) for f in factors]
+
+    dynamic = q_array is not None
+    dtype = np.dtype(precision)
+    dct_backend = codec.resolve_dct_backend(dct_backend, block_size, dtype, dct_workers)
+    state = {'q': q, 'block_size': block_size, 'shape': (height, width), 'downsample_ratio': downsample_ratio,
+             'dynamic': dynamic, 'q_array': q_array, 'channel_shapes': channel_shapes}
+
+    with open(filename, 'wb') as f:
+        container.write_header(f, state)
+        index = []
+        pending = [[] for _ in factors] # coefficient rows of every channel not written yet
+        written = [0 for _ in factors]
+
+        def flush(i, final = False):
+            blocks = np.concatenate(pending[i]) if len(pending[i]) > 1 else pending[i][0]
+            end = len(blocks) if final else len(blocks) // chunk_rows * chunk_rows
+            for row in range(0, end, chunk_rows):
+                container.write_chunk(f, index, i, written[i] + row, blocks[row:row + chunk_rows], chunk_codec, **options)
+            written[i] += end
+            pending[i] = [blocks[end:]] if end < len(blocks) else []
+
+        for top in range(0, height, strip_height):
+            strip = codec.pad_to_mcu(np.asarray(source[top:top + strip_height]), block_size, downsample_ratio)
+            luma_row = top // block_size
+
+            kwargs = {"block_size": block_size, "q": q, "downsample_ratio": downsample_ratio, "dynamic": dynamic, "dtype": dtype,
+                      "dct_backend": dct_backend, "dct_workers": dct_workers,
+                      "q_array": q_array[luma_row:luma_row + strip.shape[0] // block_size] if dynamic else None}
+
+            for i, channel in enumerate(codec.rgb_to_YCbCr(strip, dtype)):
+                for step in codec.ENCODE_STEPS:
+                    channel = step(channel, **kwargs, index = i)
+
+                pending[i].append(channel)
+                flush(i)
+
+        for i in range(len(factors)):
+            if pending[i]:
+                flush(i, final = True)
+
+        container.write_index(f, index)
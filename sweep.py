@@ -0,0 +1,163 @@
+"""
+Quality sweeps without re-encoding from scratch.
+
+Color conversion, downsampling, blocking, the DCT and (for dynamic quantization) the saliency map don't
+depend on q, so they are done once per image.  Only quantizing, zigzagging and the entropy coding, plus
+dequantizing and the inverse DCT when quality is measured, are repeated for each q.
+
+    results = sweep.quality_sweep(img, range(10, 100, 10), dynamic = True, dMode = "std_LoG")
+    jpeg, result = sweep.target_size(img, max_bytes = 20000)   # rate control, highest q that fits
+"""
+import io
+import time
+import codec
+import container
+import jpeg_class
+
+
+
+def prepare(img_array, **options):
+    """
+    JPEG of img_array taken up to the DCT, Y, Cb and Cr hold the unquantized coefficients.
+    options are the JPEG keyword arguments (block_size, downsample_ratio, dynamic, dMode, precision, ...).
+    """
+    jpeg = jpeg_class.JPEG(img_array, None, **options)
+    jpeg.encode(max_step = 4)
+
+    return jpeg
+
+
+
+def step_kwargs(jpeg, q):
+    return {"block_size": jpeg.block_size, "q": q, "downsample_ratio": jpeg.downsample_ratio,
+            "dynamic": jpeg.dynamic, "q_array": jpeg.q_array, "dtype": jpeg.dtype,
+            "dct_backend": jpeg.dct_backend, "dct_workers": jpeg.dct_workers}
+
+
+
+def quantize(jpeg, q):
+    # quantized (not yet zigzagged) Y, Cb, Cr of a prepared jpeg at quality q
+    kwargs = step_kwargs(jpeg, q)
+
+    return [codec.quantize(channel, **kwargs, index = i) for i, channel in enumerate([jpeg.Y, jpeg.Cb, jpeg.Cr])]
+
+
+
+def zigzag(jpeg, q, quantized):
+    # state of the jpeg encoded at quality q, as JPEG.__getstate__ would give it
+    kwargs = step_kwargs(jpeg, q)
+    state = {'q': q, 'block_size': jpeg.block_size, 'shape': jpeg.shape, 'downsample_ratio': jpeg.downsample_ratio,
+             'dynamic': jpeg.dynamic, 'q_array': jpeg.q_array}
+    for i, name in enumerate(jpeg_class.CHANNEL_NAMES):
+        state[name] = codec.zigzag(quantized[i], **kwargs, index = i)
+
+    return state
+
+
+
+def encoded_size(jpeg, q, quantized, chunk_codec = container.EOB_ZSTD, **options):
+    # bytes save_image would write for the quantized channels, options as in JPEG.save_image
+    state = zigzag(jpeg, q, quantized)
+
+    f = io.BytesIO()
+    container.dump(f, state, codec = chunk_codec, **options)
+
+    return f.tell()
+
+
+
+def decode(jpeg, q, quantized):
+    # rgb image decoded from the quantized channels, exactly what JPEG.decode gives for them
+    kwargs = step_kwargs(jpeg, q)
+
+    channels = []
+    for i, channel in enumerate(quantized):
+        for f in (codec.dequantize, codec.inverse_block_dct, codec.reconstruct_blocks, codec.rescale_colors):
+            channel = f(channel, **kwargs, index = i)
+        channels.append(channel)
+
+    height, width = jpeg.shape
+    return codec.YCbCr_to_rgb(channels)[:height, :width]
+
+
+
+def quality_sweep(img_array, qualities, measure_quality = True, chunk_codec = container.EOB_ZSTD, save_options = None, **options):
+    """
+    Encodes img_array at every quality in qualities from one set of DCT coefficients.
+    Returns one dict per quality with the file size in bytes, bits per pixel, encode time (quantizing + entropy
+    coding) and, with measure_quality, the PSNR against img_array and the decode time.
+    prepare_s, the time of the shared work up to the DCT, is the same in every result.
+    options are the JPEG keyword arguments, save_options those of JPEG.save_image.
+    """
+    save_options = save_options or {}
+    height, width = img_array.shape[:2]
+
+    start = time.perf_counter()
+    jpeg = prepare(img_array, **options)
+    prepare_s = time.perf_counter() - start
+
+    results = []
+    for q in qualities:
+        start = time.perf_counter()
+        quantized = quantize(jpeg, q)
+        size = encoded_size(jpeg, q, quantized, chunk_codec, **save_options)
+        result = {"q": q, "bytes": size, "bpp": 8 * size / (height * width), "encode_s": time.perf_counter() - start, "prepare_s": prepare_s}
+
+        if measure_quality:
+            start = time.perf_counter()
+            decoded = decode(jpeg, q, quantized)
+            result["decode_s"] = time.perf_counter() - start
+            result["psnr"] = float(codec.psnr(img_array, decoded))
+
+        results.append(result)
+
+    return results
+
+
+
+def target_size(img_array, max_bytes = None, bpp = None, tolerance = 0.02, q_range = (0, 100), chunk_codec = container.EOB_ZSTD,
+                save_options = None, **options):
+    """
+    Rate control: bisects over the integer qualities in q_range for the highest one whose file fits in max_bytes
+    (or bpp bits per pixel).  Every step only quantizes and entropy codes the shared DCT coefficients, and the
+    search stops early once a fitting size is within tolerance (relative) of the budget.
+    Returns (jpeg, result): the JPEG encoded at that quality, ready for save_image with the same chunk_codec and
+    save_options, and a dict with q, bytes, bpp and the number of sizes tried.  If even the lowest quality is over
+    budget, that is what's returned.
+    options are the JPEG keyword arguments.
+    """
+    save_options = save_options or {}
+    height, width = img_array.shape[:2]
+    if max_bytes is None:
+        if bpp is None:
+            raise ValueError("give a budget, max_bytes or bpp")
+        max_bytes = bpp * height * width / 8
+
+    jpeg = prepare(img_array, **options)
+    sizes = {}
+
+    def size(q):
+        quantized = quantize(jpeg, q)
+        sizes[q] = (encoded_size(jpeg, q, quantized, chunk_codec, **save_options), quantized)
+        return sizes[q][0]
+
+    # invariant: low fits (or is the lowest there is), high doesn't
+    low, high = q_range
+    if size(high) <= max_bytes:
+        best = high
+    else:
+        best = low
+        size(low)
+        while high - low > 1 and sizes[best][0] <= max_bytes and max_bytes - sizes[best][0] > tolerance * max_bytes:
+            middle = (low + high) // 2
+            if size(middle) <= max_bytes:
+                low = best = middle
+            else:
+                high = middle
+
+    nbytes, quantized = sizes[best]
+    state = zigzag(jpeg, best, quantized)
+    jpeg.q = best
+    jpeg.Y, jpeg.Cb, jpeg.Cr = state['Y'], state['Cb'], state['Cr']
+
+    return jpeg, {"q": best, "bytes": nbytes, "bpp": 8 * nbytes / (height * width), "iterations": len(sizes)}
@@ -0,0 +1,80 @@
+import io
+import numpy as np
+import pytest
+import container
+import entropy
+
+
+def random_blocks(rng, rows, cols, density, n = 64):
+    blocks = np.zeros((rows, cols, n), dtype=np.int8)
+    nonzero = rng.random(blocks.shape) < density
+    blocks[nonzero] = rng.integers(-128, 128, nonzero.sum())
+    return blocks
+
+
+
+@pytest.mark.parametrize("seed", range(40))
+@pytest.mark.parametrize("density", [0, 0.01, 0.1, 0.5, 1])
+def test_round_trip(seed, density):
+    rng = np.random.default_rng(seed)
+    blocks = random_blocks(rng, rng.integers(1, 6), rng.integers(1, 40), density)
+    if seed % 3 == 0:
+        blocks[..., 0] = rng.integers(-128, 128) # a constant DC, so whole rows of blocks are empty
+
+    assert np.array_equal(entropy.decode(entropy.encode(blocks), blocks.shape), blocks)
+
+
+
+def test_runs_longer_than_max_run():
+    blocks = np.zeros((40, 4000, 64), dtype=np.int8)
+    blocks[3, 5, 7] = 3
+    blocks[-1, -1, -1] = -1
+
+    assert np.array_equal(entropy.decode(entropy.encode(blocks), blocks.shape), blocks)
+
+
+
+@pytest.mark.parametrize("shape", [(1, 1, 64), (2, 3, 16)])
+def test_all_zero(shape):
+    blocks = np.zeros(shape, dtype=np.int8)
+
+    assert np.array_equal(entropy.decode(entropy.encode(blocks), shape), blocks)
+
+
+
+def test_decodes_into_out_and_from_memoryview():
+    blocks = random_blocks(np.random.default_rng(0), 4, 10, 0.05)
+    out = np.zeros((6, 10, 64), dtype=np.int8)
+
+    entropy.decode(memoryview(entropy.encode(blocks)), blocks.shape, out = out[1:5])
+
+    assert np.array_equal(out[1:5], blocks)
+    assert not out[0].any() and not out[5].any()
+
+
+
+def test_code_lengths_are_limited():
+    # fibonacci frequencies give the deepest huffman tree there is
+    frequencies = [1, 1]
+    while len(frequencies) < 30:
+        frequencies.append(frequencies[-1] + frequencies[-2])
+
+    lengths, order = entropy.code_lengths(frequencies)
+
+    assert lengths.max() <= entropy.MAX_CODE_LENGTH
+    assert sum(2.0 ** -lengths) <= 1 # still a prefix code
+
+
+
+def test_container_round_trip():
+    rng = np.random.default_rng(1)
+    state = {'q': 50, 'block_size': 8, 'shape': (80, 80), 'downsample_ratio': "4:2:0", 'dynamic': False, 'q_array': None,
+             'Y': random_blocks(rng, 10, 10, 0.05), 'Cb': random_blocks(rng, 5, 5, 0.05), 'Cr': random_blocks(rng, 5, 5, 0.05)}
+
+    f = io.BytesIO()
+    container.dump(f, state, chunk_rows = 4, codec = container.HUFFMAN)
+    f.seek(0)
+    loaded = container.load(f)
+
+    for name in container.CHANNELS:
+        assert np.array_equal(loaded[name], state[name])